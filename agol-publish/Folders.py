@@ -18,6 +18,9 @@ import sys
 from tqdm import tqdm
 import pydash
 
+import crawler
+import timing
+
 
 agol_items_table_name = 'SGID.META.AGOLItems'
 
@@ -35,10 +38,11 @@ def get_folders_to_items():
   print('getting folders and items for user...')
   user = arcgis.gis.User(gis, username)
 
-  folders = {}
-  for folder in user.folders:
-    results = user.items(folder, max_items=1000)
-    folders.setdefault(folder['title'], [item.id for item in results])
+  with timing.span('crawl items'):
+    folders = {folder['title']: set() for folder in user.folders}
+    for item, folder in crawler.user_items(gis, username):
+      if folder:
+        folders[folder].add(item.id)
 
   return folders
 
@@ -52,14 +56,16 @@ def create_folders():
 
   for folder in tqdm(folders):
     print(f'creating {folder}')
-    gis.content.create_folder(folder)
+    with timing.span('create folder', folder=folder):
+      gis.content.create_folder(folder)
 
 
 def move_item_if_needed(item, folder, folders):
   if not item.id in folders[folder]:
     error_message = f'error moving {item.title} ({item.id})!'
     try:
-      result = item.move(folder)
+      with timing.span('move', item=item.id, folder=folder):
+        result = item.move(folder)
 
       if result['success'] == False:
         print(error_message)
@@ -74,15 +80,22 @@ def update_folders_for_meta_table_items():
   query = 'AGOL_ITEM_ID <> \'EXTERNAL\''
   with arcpy.da.SearchCursor(agol_items_table, ['TABLENAME', 'AGOL_ITEM_ID', 'AGOL_PUBLISHED_NAME'], query) as cursor:
     for tablename, agol_id, agol_name in tqdm(cursor):
-      item = arcgis.gis.Item(gis, agol_id)
+      with timing.span('item', item=agol_id):
+        with timing.span('get item', item=agol_id):
+          item = arcgis.gis.Item(gis, agol_id)
 
-      folder = get_folder_from_fc(tablename)
+        folder = get_folder_from_fc(tablename)
 
-      move_item_if_needed(item, folder, folders)
+        move_item_if_needed(item, folder, folders)
 
-      for related_item in item.related_items('Service2Data'):
-        move_item_if_needed(related_item, folder, folders)
+        with timing.span('related items', item=agol_id):
+          related_items = item.related_items('Service2Data')
+        for related_item in related_items:
+          move_item_if_needed(related_item, folder, folders)
 
 
-# create_folders()
-# update_folders_for_meta_table_items()
+if __name__ == '__main__':
+  timing.start('Folders', timing.default_path('Folders'))
+  # create_folders()
+  # update_folders_for_meta_table_items()
+  timing.print_summary()
@@ -1,12 +1,12 @@
+import argparse
 import csv
 import datetime
 import getpass
 import json
+import multiprocessing
 import os
 import pprint
-import pygsheets
 import shutil
-import sys
 import tempfile
 import traceback
 from re import sub
@@ -14,10 +14,20 @@ from re import sub
 import arcgis
 import arcpy
 
+import categories
+import crawler
+import finalizer
+import journal
+import pipeline
+import project_session
+import projection_cache
 import settings as s
+import sheets
+import timing
+import uploads
 
 
-def project_data(sgid_table, fgdb_folder, fgdb, is_table):
+def project_data(sgid_table, fgdb_folder, fgdb, is_table, cache=None):
     '''Project a feature class from SDE into web mercator. 
     Non-spatial tables are just copied over as-is.
 
@@ -26,6 +36,8 @@ def project_data(sgid_table, fgdb_folder, fgdb, is_table):
     fgdb_folder: temp folder path
     fgdb: temp fgdb name
     is_table: boolean to flag if sgid_table is just tabular (non-spatial)
+    cache: projection_cache.ProjectionCache; if specified, data projected
+           by an earlier run is reused unless sgid_table has changed since
 
     returns: path to projected data 
     '''
@@ -35,87 +47,104 @@ def project_data(sgid_table, fgdb_folder, fgdb, is_table):
     name = sgid_table.split(os.path.sep)[-1].replace('.', '_')
     output_table = os.path.join(fgdb_folder, fgdb, name)
 
-    if not arcpy.Exists(os.path.join(fgdb_folder, fgdb)):
-        #: create fgdb if it's missing
-        print(f'creating {fgdb}')
-        arcpy.management.CreateFileGDB(fgdb_folder, fgdb)
+    def project(sgid_table, output_table):
+        if not arcpy.Exists(os.path.join(fgdb_folder, fgdb)):
+            #: create fgdb if it's missing
+            print(f'creating {fgdb}')
+            arcpy.management.CreateFileGDB(fgdb_folder, fgdb)
 
-    #: Delete the feature class if it already exists. Don't use scratch for
-    #: long-term storage.
-    if arcpy.Exists(output_table):
-        arcpy.Delete_management(output_table)
+        #: Delete the feature class if it already exists. Don't use scratch for
+        #: long-term storage.
+        if arcpy.Exists(output_table):
+            arcpy.Delete_management(output_table)
 
-    print('importing/projecting data')
-    if is_table:
-        arcpy.management.Copy(sgid_table, output_table)
-    else:
-        arcpy.management.Project(sgid_table, output_table, web_mercator,
-                                 transformation)
+        print('importing/projecting data')
+        if is_table:
+            arcpy.management.Copy(sgid_table, output_table)
+        else:
+            arcpy.management.Project(sgid_table, output_table, web_mercator,
+                                     transformation)
+
+    if cache:
+        return cache.fetch(sgid_table, output_table, project)
 
+    project(sgid_table, output_table)
     return output_table
 
 
-def upload_layer(gis, service_definition, info, protect=True):
+def publish_layer(gis, service_definition):
     '''Upload a service definition file to AGOL and publish it as a
-    Hosted Feature Layer, setting appropriate information.
+    Hosted Feature Layer. The file is uploaded in parts; if the upload is
+    interrupted, the next call for the same file resumes it.
 
     Parameters:
     gis: An ArcGIS API gis item.
     service_definition: path to a service definition file created in ArcGIS Pro
+
+    returns: tuple of the service definition item and the published item
+    '''
+
+    name = os.path.basename(service_definition)
+
+    print("uploading")
+    with timing.span('upload', file=name):
+        sd_item = uploads.upload_item(gis, service_definition)
+
+    #: Publishing
+    print("publishing")
+    with timing.span('publish', file=name, item=sd_item.itemid):
+        published_item = sd_item.publish()
+
+    return sd_item, published_item
+
+
+def finalize_layer(published_item, sd_item, info, protect=True,
+                   item_finalizer=None):
+    '''Share a newly published Hosted Feature Layer and set its
+    information, folder, and capabilities. The information is set in one
+    update; sharing, protection, moves, and capabilities then run at the
+    same time.
+
+    Parameters:
+    published_item: the published feature layer item
+    sd_item: the service definition item it was published from
     info: a dictionary of the layer's information:
         name: layer name/title (string)
         summary: Summary snippet at top of AGOL page (string, max 2048 chars)
-        groups: list of group names to share layer with (list of strings)
+        groups: list of group ids (or names) to share layer with
         tags: comma-separated string of tags (string)
         description: AGOL description (string)
         terms_of_use: AGOL terms of use/license info (string)
         credits: AGOL Credits/Attribution (string)
-        folder: AGOL org's folder to move item to
+        folder: AGOL org's folder (title or folder dict) to move item to
     protect: if True, set AGOL flag to prevent item from being deleted
+    item_finalizer: finalizer.ItemFinalizer to run the operations with; if
+                    None, a new one is used
 
-    returns: the published feature layer's itemid
+    returns: list of finalizer.OperationResults (raises
+             finalizer.FinalizeError if any failed)
     '''
+    item_finalizer = item_finalizer or finalizer.ItemFinalizer()
 
-    print("uploading")
-    sd_item = gis.content.add({}, data=service_definition)
-
-    #: Publishing
-    print("publishing")
-    published_item = sd_item.publish()
-
-    #: Updating information
-    print("sharing") #: Everyone and groups.
-    published_item.share(everyone=True, org=True, groups=info['groups'])
-    if protect:
-        print("delete protection")
-        published_item.protect(enable=True)
-    # sd_item.protect(enable=True)
     # print('authoritative')
     # published_item.content_status = 'authoritative'
 
-    print("updating info")
-    published_item.update(item_properties={
-        'tags': info['tags'],
-        'description': info['description'],
-        'licenseInfo': info['terms_of_use'],
-        'snippet': info['summary'],
-        'accessInformation': info['credits']
-        })
-
-    print('folder')
-    published_item.move(info['folder'])
-    sd_item.move(info['folder'])
-
-    #: Allow Downloads
-    print("downloads")
-    manager = arcgis.features.FeatureLayerCollection.fromitem(published_item).manager
-    manager.update_definition({ 'capabilities': 'Query,Extract' })
-
-    return published_item.itemid
-
-
-def create_service_definition(layer_info, sde_path, temp_dir, project_path, 
-                              map_name, describe):
+    return item_finalizer.finalize(published_item, sd_item,
+                                   properties={
+                                       'tags': info['tags'],
+                                       'description': info['description'],
+                                       'licenseInfo': info['terms_of_use'],
+                                       'snippet': info['summary'],
+                                       'accessInformation': info['credits']
+                                   },
+                                   groups=info['groups'],  #: Everyone and groups.
+                                   folder=info['folder'],
+                                   protect=protect,
+                                   capabilities='Query,Extract')  #: Allow Downloads
+
+
+def create_service_definition(layer_info, sde_path, temp_dir, session,
+                              describe, projected_table=None):
     '''Create a service defintion for a layer to be uploaded to AGOL from an
     SDE using an existing ArcGIS Pro project.
     
@@ -126,49 +155,31 @@ def create_service_definition(layer_info, sde_path, temp_dir, project_path,
         title: title of the item for AGOL (string)
     sde_path: Path to the source .sde connection file
     temp_dir: Directory for holding reprojected fgdb and .sddraft & .sd files
-    project_path: Path to an existing ArcGIS Pro project
-    map_name: Name of the map in the Pro project to use
+    session: project_session.PublishingSession for the Pro project and map
+             to stage with
     describe: results of arcpy.da.Describe() on feature class
+    projected_table: path to data already projected by project_data(); if
+                     None, the data is projected first
 
     returns: path to the .sd file
     '''
 
+    layer_name = layer_info['fc_name'].split('.')[-1]
+    added = False
+
     try:
         start = datetime.datetime.now()
 
         sgid_table = os.path.join(sde_path, layer_info['fc_name'])
         is_table = describe['datasetType'] == 'Table'
 
-        projected_table = project_data(sgid_table, temp_dir, 'tempfgdb.gdb',
-                                       is_table)
-
-        #: Get project and map
-        proj = arcpy.mp.ArcGISProject(project_path)
-        for m in proj.listMaps():
-            if m.name == map_name:
-                agol_map = m
-        del m
-
-        #: Remove any existing layers
-        for l in agol_map.listLayers():
-            agol_map.removeLayer(l)
-        for t in agol_map.listTables():
-            agol_map.removeTable(t)
+        if not projected_table:
+            projected_table = project_data(sgid_table, temp_dir, 'tempfgdb.gdb',
+                                           is_table)
 
         # : Add layer
-        layer = agol_map.addDataFromPath(projected_table)
-        layer.name = layer_info['fc_name'].split('.')[-1]
-
-        #: Verify map projection
-        cim = agol_map.getDefinition('V2')
-        if cim.spatialReference['wkid'] != 3857:
-            print('changing map projection')
-            cim.spatialReference = {'wkid':3857}
-            agol_map.setDefinition(cim)
-        else:
-            cim = None
-
-        proj.save()
+        session.add(projected_table, layer_name)
+        added = True
 
         item_name = layer_info['title']
         if not item_name.startswith('Utah'):
@@ -178,9 +189,7 @@ def create_service_definition(layer_info, sde_path, temp_dir, project_path,
         print("staging")
         draft_path = os.path.join(temp_dir, f'{item_name}.sddraft')
         sd_path = draft_path[:-5]
-        sharing_draft = agol_map.getWebLayerSharingDraft('HOSTING_SERVER',
-                                                         'FEATURE', item_name,
-                                                         [layer])
+        sharing_draft = session.sharing_draft(layer_name, item_name)
         sharing_draft.exportToSDDraft(draft_path)
         arcpy.server.StageService(draft_path, sd_path)
 
@@ -201,43 +210,42 @@ def create_service_definition(layer_info, sde_path, temp_dir, project_path,
         #: tempfile.TemporaryDirectory:'). Deleting any and all references to
         #: the layer and anything in the map doesn't seem to help, nor does
         #: deleting the feature classes from the temp fgdb prior to trying to
-        #: delete the fgdb itself.
+        #: delete the fgdb itself. PublishingSession.remove() repoints the
+        #: layer's connection before removing it.
 
-        if layer and not is_table:
-            layer.updateConnectionProperties(os.path.join(temp_dir, 'tempfgdb.gdb'), r'c:\foo\bar.gdb', auto_update_joins_and_relates=False, validate=False)
+        if added:
+            session.remove(layer_name)
 
-            agol_map.removeLayer(layer)
-            proj.save()
+    return sd_path
 
-        # layer = None
-        # cim = None
-        # agol_map = None
-        # proj = None
-        # sharing_draft = None
 
-        # del layer
-        # del cim
-        # del agol_map
-        # del proj
-        # del sharing_draft
+def get_destination(entry):
+    '''Get the group and folder for an AGOL item.
 
-        #: Delete feature class
-        # print(f'Deleting {projected_table}...')
-        # arcpy.Delete_management(projected_table)
-        # tempgdb = os.path.join(temp_dir, 'tempfgdb.gdb')
-        # print(f'Deleting {tempgdb}...')
-        # shutil.rmtree(tempgdb)
+    Parameters:
+    entry: list from CSV: [fully-qualifed FC name, fc title, credit, method]
 
-    return sd_path
+    returns: (group title, folder title)
+    '''
+    category = entry[0].split('.')[-2].title()
 
+    if entry[3] == 'shelved':
+        return 'AGRC Shelf', 'AGRC_Shelved'
+    elif entry[3] == 'static':
+        return f'Utah SGID {category}', category
+    else:
+        raise ValueError(f'Unknown shelving category: {entry[3]}')
 
-def get_info(entry, generic_terms_of_use):
+
+def get_info(entry, generic_terms_of_use, resolver=None):
     '''Get the info needed for publishing AGOL item.
     
     Parameters:
     entry: list from CSV: [fully-qualifed FC name, fc title, credit, method]
     generic_terms_of_use: Standard license info for items that don't have 
                           license info in their metadata
+    resolver: categories.CategoryResolver to look the item's group and folder
+              up with; if None, they are left as titles
     
     returns: dict of relevant information
     '''
@@ -268,19 +276,18 @@ def get_info(entry, generic_terms_of_use):
     else:
         terms = generic_terms_of_use
 
+    group, folder = get_destination(entry)
     if entry[3] == 'shelved':
-        group = 'AGRC Shelf'
         tags.append('shelved')
-        folder = 'AGRC_Shelved'
         description = f'{shelved_disclaimer} <p> </p> <p>{description}</p>'
     elif entry[3] == 'static':
-        group = f'Utah SGID {category}'
         tags.append('static')
         tags.append(category)
-        folder = category
         description = f'{static_disclaimer} <p> </p> <p>{description}</p>'
-    else:
-        raise ValueError(f'Unknown shelving category: {entry[3]}')
+
+    if resolver:
+        group = resolver.group_id(group)
+        folder = resolver.folder(folder)
 
     item_info = {
         'name': entry[1],
@@ -296,13 +303,14 @@ def get_info(entry, generic_terms_of_use):
     return item_info
 
 
-def log_gsheets(action_info, gsheet_auth=None, gsheet_keys=None):
-    '''Document actions to stewardship doc.
+def log_gsheets(action_info, session):
+    '''Document actions to stewardship doc. Changes are queued in the
+    session and sent to Google when it flushes.
     
     Parameters:
     action_info: a list of info relevant to a single feature class
-    gsheet_auth: path to Google sheets authorization file
-    gsheet_keys: Tuple of keys to stewardship doc [0] and agol items doc [1]
+    session: a sheets.StewardshipSession for the stewardship and agol items
+             docs
 
     returns: row number of pre-existing data in stewardship doc; None if
              no pre-existing data (but it will create a new row in this 
@@ -311,16 +319,6 @@ def log_gsheets(action_info, gsheet_auth=None, gsheet_keys=None):
 
     updated_row = None
 
-    client = pygsheets.authorize(service_file=gsheet_auth)
-
-    #: Update stewardship doc
-    sheet = client.open_by_key(gsheet_keys[0])
-    worksheet = sheet[1]  #: Stewardship sheet is second tab
-
-    #: Get all rows so we can work locally before update_values()
-    rows = []
-    for row in worksheet:
-        rows.append(row)
     #: Row Structure:
     #: [0 Issue, 1 Authoritative Access From, 2 SGID Data Layer,
     #: 3 Refresh Cycle (Days), 4 Last Update, 5 Days From Last Refresh,
@@ -334,60 +332,52 @@ def log_gsheets(action_info, gsheet_auth=None, gsheet_keys=None):
     #: [0 AGOL title, 1 operation, 2 SGID name for stewardship doc, 
     #: 3 description, 4 source/credit, 5 shape type, 6 endpoint, 7 AGOL item ID]
 
-    updated = False
-
-    for i, row in enumerate(rows):
-        if row[2] == action_info[2]:
+    #: Hold the session's lock so no other thread changes the rows between
+    #: finding and updating them
+    with session.lock:
+        for rownum, row in session.find(action_info[2]):
             temp_row = row
             temp_row[1] = 'AGRC AGOL'
             temp_row[21] = action_info[6]
             temp_row[24] = f'AGOL category: {action_info[1]} - {row[24]}'
-            rownum = i+1
-            start = f'A{rownum}'
-            worksheet.update_values(start, [temp_row])
-            updated = True
+            session.update(rownum, temp_row)
             updated_row = rownum
 
-    if not updated:
-        print(f'{action_info[2]} not found in stewardship doc')
-        new_row = []
-        new_row.append('')  #: Leading Note 
-        new_row.append('AGRC AGOL')  #: current source
-        new_row.append(action_info[2])
-        new_row.append('Static')  #: refresh cycle
-        new_row.append('')  #: Last update
-        new_row.append('')  #: Days from last update
-        new_row.append('')  #: Days to refresh
-        new_row.append(sub('<[^<]+?>', '', action_info[3]).strip())  #: Description
-        new_row.append(action_info[4])  #: Data Source
-        new_row.append('')  #:  Use Restrictions
-        new_row.append('')  #:  Website URL
-        new_row.append('')  #: Anchor note
-        new_row.append(action_info[5])  #: Data type
-        new_row.append('')  #: PEL Layer
-        new_row.append('')  #: PEL Status
-        new_row.append('')  #: Governance/Agreement
-        new_row.append('')  #: PEL Inclusion
-        new_row.append('')  #: Agency Contact Name
-        new_row.append('')  #: Agency Contact Email
-        new_row.append('')  #: SGID Coordination
-        new_row.append('')  #: Archival Schedule
-        new_row.append(action_info[6])  #: Endpoint
-        new_row.append('')  #: Tier
-        new_row.append('')  #: Webapp
-        new_row.append(f'Added by NightStocker - AGOL category: {action_info[1]}')  #: Notes
-        new_row.append('')  #: Deprecated
-
-        worksheet.insert_rows(worksheet.rows, values=new_row, inherit=True)
-
-
+        if updated_row is None:
+            print(f'{action_info[2]} not found in stewardship doc')
+            new_row = []
+            new_row.append('')  #: Leading Note 
+            new_row.append('AGRC AGOL')  #: current source
+            new_row.append(action_info[2])
+            new_row.append('Static')  #: refresh cycle
+            new_row.append('')  #: Last update
+            new_row.append('')  #: Days from last update
+            new_row.append('')  #: Days to refresh
+            new_row.append(sub('<[^<]+?>', '', action_info[3]).strip())  #: Description
+            new_row.append(action_info[4])  #: Data Source
+            new_row.append('')  #:  Use Restrictions
+            new_row.append('')  #:  Website URL
+            new_row.append('')  #: Anchor note
+            new_row.append(action_info[5])  #: Data type
+            new_row.append('')  #: PEL Layer
+            new_row.append('')  #: PEL Status
+            new_row.append('')  #: Governance/Agreement
+            new_row.append('')  #: PEL Inclusion
+            new_row.append('')  #: Agency Contact Name
+            new_row.append('')  #: Agency Contact Email
+            new_row.append('')  #: SGID Coordination
+            new_row.append('')  #: Archival Schedule
+            new_row.append(action_info[6])  #: Endpoint
+            new_row.append('')  #: Tier
+            new_row.append('')  #: Webapp
+            new_row.append(f'Added by NightStocker - AGOL category: {action_info[1]}')  #: Notes
+            new_row.append('')  #: Deprecated
+
+            session.append(new_row)
 
     #: Update list of new additions to AGOL
-    sheet = client.open_by_key(gsheet_keys[1])
-    worksheet = sheet[0]
     row = [action_info[0], action_info[7], f'https://utah.maps.arcgis.com/home/item.html/?id={action_info[7]}']
-    worksheet.insert_rows(worksheet.rows, values=row, inherit=True)
-            
+    session.append_agol_item(row)
 
     return updated_row
 
@@ -408,6 +398,126 @@ def log_csv(action_info, log_path):
         print('Error writing log file.')
 
 
+def stage_layer(layer_info, sde_path, temp_dir, session, cache=None):
+    '''Describe a layer and, unless it is just a table, project it and
+    create its service definition. Errors are caught and returned rather
+    than raised so that this can be run in a worker process.
+
+    Parameters:
+    layer_info: Dictionary of info about the layer (see
+                create_service_definition()), plus:
+        projected: path to the layer's data projected by a previous run, or
+                   None to project it again
+    sde_path: Path to the source .sde connection file
+    temp_dir: Directory for holding reprojected fgdb and .sddraft & .sd files
+    session: project_session.PublishingSession for the Pro project and map
+             to stage with
+    cache: projection_cache.ProjectionCache to keep projected data in; if
+           None, data is projected into temp_dir every time
+
+    returns: dict of the results:
+        is_table: True if the layer is non-spatial and wasn't staged
+        shape: lowercased shape type of the layer
+        projected_path: path to the projected data (None if not projected)
+        projection: 'hit', 'new', or 'changed' if cache was used
+        sd_path: path to the .sd file (None if not staged)
+        error: error message if staging failed, otherwise None
+    '''
+    result = {'is_table': False, 'shape': None, 'projected_path': None,
+              'projection': None, 'sd_path': None, 'error': None}
+
+    try:
+        print(f'describing {layer_info["fc_name"]}')
+        with timing.span('describe', layer=layer_info['fc_name']):
+            describe = arcpy.da.Describe(os.path.join(sde_path,
+                                                      layer_info['fc_name']))
+        result['is_table'] = describe['datasetType'] == 'Table'
+        if result['is_table']:
+            return result
+        result['shape'] = describe['shapeType'].lower()
+
+        sgid_table = os.path.join(sde_path, layer_info['fc_name'])
+        result['projected_path'] = layer_info.get('projected')
+        if result['projected_path']:
+            print(f'reusing {result["projected_path"]}')
+        elif cache:
+            #: One fgdb per layer so that workers never write to the same one
+            fgdb = layer_info['fc_name'].replace('.', '_') + '.gdb'
+            with timing.span('project', layer=layer_info['fc_name']) as span:
+                result['projected_path'] = project_data(sgid_table, cache.folder,
+                                                        fgdb, False, cache)
+                result['projection'] = span['cache'] = cache.results[sgid_table]
+        else:
+            with timing.span('project', layer=layer_info['fc_name']):
+                result['projected_path'] = project_data(sgid_table, temp_dir,
+                                                        'tempfgdb.gdb', False)
+
+        print('creating sd')
+        with timing.span('stage', layer=layer_info['fc_name']):
+            result['sd_path'] = create_service_definition(layer_info, sde_path,
+                                                          temp_dir, session,
+                                                          describe,
+                                                          result['projected_path'])
+    except arcpy.ExecuteError:
+        message = arcpy.GetMessages()
+        print(message)
+        result['error'] = message.replace(',', ';')
+    except Exception as error:
+        #: Anything else (a bad describe, a missing path, a locked cache) is
+        #: returned too; raised in a worker it would abort the whole run
+        print(f'Error with {layer_info["title"]}:')
+        traceback.print_exc()
+        result['error'] = f'{type(error).__name__}: {error}'.replace(',', ';')
+
+    return result
+
+
+#: Per-process settings for staging workers, set by init_staging_worker()
+worker_settings = {}
+
+
+def init_staging_worker(temp_root, project_path, cache_dir=None, run=None):
+    '''Give a staging worker process its own scratch directory (and so its
+    own temporary fgdb) and its own copy of the Pro project so that several
+    workers can project and stage layers at the same time without fighting
+    over locks. The copy is opened once in a PublishingSession for all the
+    layers the worker stages; it is thrown away at the end, so it's never
+    saved.
+
+    Parameters:
+    temp_root: Directory to create the worker's scratch directory in
+    project_path: Path to the ArcGIS Pro project to copy
+    cache_dir: if specified, folder of the shared projection cache
+    run: label of the run being timed; the worker's spans are sent back to
+         the main process with each result
+    '''
+    timing.timer = timing.Timer(run)
+
+    worker_dir = os.path.join(temp_root, f'worker_{os.getpid()}')
+    os.makedirs(worker_dir, exist_ok=True)  #: A resumed run reuses temp_root
+    worker_project = os.path.join(worker_dir,
+                                  os.path.basename(project_path))
+    arcpy.mp.ArcGISProject(project_path).saveACopy(worker_project)
+
+    worker_settings['temp_dir'] = worker_dir
+    worker_settings['session'] = project_session.PublishingSession(worker_project,
+                                                                   map_name)
+    worker_settings['cache'] = None
+    if cache_dir:
+        worker_settings['cache'] = projection_cache.ProjectionCache(cache_dir)
+
+
+def stage_layer_in_worker(layer_info):
+    '''stage_layer() using the worker process's own scratch directory and
+    project session. The result includes the worker's timing spans under
+    'spans'.
+    '''
+    result = stage_layer(layer_info, sde_path, worker_settings['temp_dir'],
+                         worker_settings['session'], worker_settings['cache'])
+    result['spans'] = timing.timer.drain()
+    return result
+
+
 sde_path = s.SDE_PATH
 project_path = s.PROJECT_PATH
 map_name = s.MAP_NAME
@@ -417,128 +527,375 @@ log_path = s.LOG_PATH
 gsheet_auth = s.GSHEET_AUTH
 stewardship_sheet_key = s.STEWARDSHIP_SHEET_KEY
 agol_sheet_key = s.AGOL_SHEET_KEY
+journal_path = s.JOURNAL_PATH
+projection_cache_dir = s.PROJECTION_CACHE_DIR
+timing_path = s.TIMING_PATH
 
-#: Create a temp dir in the user's temporary directory with the pid in the 
-#: directory name. If it exists already, delete it (shelved_ prefix should be
-#: unique enough to keep us from stomping on another program's temp dir).
-temp_dir = os.path.join(tempfile.gettempdir(), f'shelved_{os.getpid()}')
-if os.path.exists(temp_dir):
-    shutil.rmtree(temp_dir)
-os.mkdir(temp_dir)
-
-
-#: Connect to AGOL
-agol_user = sys.argv[1]
-gis = arcgis.gis.GIS('https://www.arcgis.com',
-                     agol_user, 
-                     getpass.getpass(prompt=f'{agol_user}\'s password: '))
-
-layers = []
-with open(list_csv) as list_file:
-    reader = csv.reader(list_file)
-    # next(reader)
-    for row in reader:
-        if row[3] != 'removed': #: Just don't even add removed items to the list
-            layers.append(row)
-
-#: Get metadata for whole SDE, terms of use
+#: Get metadata for whole SDE
 metadata_file_path = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'metadata.json')
 metadata_lookup = None
 with open(metadata_file_path, 'r') as meta_file:
     metadata_lookup = json.loads(meta_file.read())
 
-with open(terms_of_use_path) as terms_file:
-    generic_terms_of_use = terms_file.read()
-
-log = []
-updated_rows = {}
-
-for feature_class_name, item_title, source, action in layers:
-    print(f'\n Starting {feature_class_name}')
-
-    layer_info = {
-        'fc_name':feature_class_name,
-        'title':item_title
-    }
-
-    print('describing')
-    describe = arcpy.da.Describe(os.path.join(sde_path, feature_class_name))
-    is_table = describe['datasetType'] == 'Table'
-    try:
-        #: Check if it's a table, skip if true
-        if is_table:
-
-            log_entry = [item_title, 'Table: not uploaded']
-            print(f'{feature_class_name} is a table; not uploading')
-            log.append(log_entry)
 
+def main():
+    parser = argparse.ArgumentParser(description='Publish the layers listed '
+                                     'in the shelving csv to AGOL')
+    parser.add_argument('agol_user', help='AGOL user to publish as')
+    parser.add_argument('--stage-workers', '--workers', type=int, default=1,
+                        dest='stage_workers',
+                        help='Number of layers to project and stage at once, '
+                        'each in its own process (default: 1, no extra '
+                        'processes)')
+    parser.add_argument('--upload-workers', type=int, default=1,
+                        help='Number of layers to upload and finalize in AGOL '
+                        'at once (default: 1)')
+    parser.add_argument('--log-workers', type=int, default=1,
+                        help='Number of layers to log to the Google sheets at '
+                        'once (default: 1)')
+    parser.add_argument('--queue-size', type=int, default=2,
+                        help='Number of staged layers allowed to wait for '
+                        'upload (and uploaded layers to wait for logging) '
+                        '(default: 2)')
+    parser.add_argument('--sheet-batch', type=int, default=10,
+                        help='Number of published layers to log before '
+                        'sending the queued Google sheet changes; everything '
+                        'left is sent at the end (default: 10)')
+    parser.add_argument('--save-every', type=int, default=25,
+                        help='Number of layers to stage between saves of the '
+                        'Pro project when staging in this process '
+                        '(default: 25)')
+    parser.add_argument('--journal', default=journal_path,
+                        help='Where to record how far each layer got '
+                        f'(default: {journal_path})')
+    parser.add_argument('--resume', action='store_true',
+                        help='Pick up where the last run using this journal '
+                        'stopped, skipping the stages each layer finished')
+    parser.add_argument('--projection-cache', action='store_true',
+                        help=f'Keep projections in {projection_cache_dir} and '
+                        'reuse them while their sources are unchanged. Only '
+                        'worth it when the same layers are published again: '
+                        'every layer is fingerprinted (a full read of sources '
+                        'without editor tracking) and its fgdb is kept until '
+                        'removed by hand')
+    args = parser.parse_args()
+
+    timing.start('NightStocker', timing_path)
+    progress = journal.Journal(args.journal, args.resume)
+
+    #: A resumed run reuses the previous run's temp dir and the artifacts in it
+    temp_dir = progress.run.get('temp_dir') if args.resume else None
+    if temp_dir and os.path.exists(temp_dir):
+        print(f'Resuming with the artifacts in {temp_dir}')
+    else:
+        #: Create a temp dir in the user's temporary directory with the pid in the 
+        #: directory name. If it exists already, delete it (shelved_ prefix should be
+        #: unique enough to keep us from stomping on another program's temp dir).
+        temp_dir = os.path.join(tempfile.gettempdir(), f'shelved_{os.getpid()}')
+        if os.path.exists(temp_dir):
+            shutil.rmtree(temp_dir)
+        os.mkdir(temp_dir)
+        progress.start(temp_dir=temp_dir)
+
+
+    #: Connect to AGOL
+    agol_user = args.agol_user
+    gis = arcgis.gis.GIS('https://www.arcgis.com',
+                         agol_user, 
+                         getpass.getpass(prompt=f'{agol_user}\'s password: '))
+
+    layers = []
+    with open(list_csv) as list_file:
+        reader = csv.reader(list_file)
+        # next(reader)
+        for row in reader:
+            if row[3] != 'removed': #: Just don't even add removed items to the list
+                layers.append(row)
+
+    #: Get terms of use
+    with open(terms_of_use_path) as terms_file:
+        generic_terms_of_use = terms_file.read()
+
+    log = []
+    updated_rows = {}
+
+    def sheets_flushed(feature_class_names):
+        for feature_class_name in feature_class_names:
+            progress.record(feature_class_name, 'logged')
+
+    #: Load the stewardship doc once; changes are sent in batches. Layers
+    #: aren't journaled as logged until their batch has been sent.
+    session = sheets.StewardshipSession(gsheet_auth,
+                                        (stewardship_sheet_key, agol_sheet_key),
+                                        args.sheet_batch, sheets_flushed)
+
+    #: Index the titles of all the org's hosted feature layers once instead of
+    #: a fuzzy content.search per layer
+    print('Indexing published feature layers...')
+    with timing.span('title index'):
+        published = crawler.TitleIndex(gis, f'orgid:{gis.properties.id}', 'Feature Service')
+    print(f'{len(published)} titles indexed')
+
+    def agol_title(item_title):
+        '''prepend Utah if needed to match uploaded item title'''
+        if not item_title.startswith('Utah'):
+            return f'Utah {item_title}'
+        return item_title
+
+    #: Check if each layer already exists in AGOL, skip if true
+    to_stage = []
+    for feature_class_name, item_title, source, action in layers:
+        if progress.reached(feature_class_name, 'logged'):
+            print(f'{feature_class_name} finished in a previous run')
             continue
-
-        #: Check if layer already exists in AGOL, skip if true
-        item_name = item_title  #: prepend Utah if needed to match uploaded item title
-        if not item_name.startswith('Utah'):
-            item_name = f'Utah {item_name}'
-        existing = gis.content.search(item_name, item_type='Feature Layer')
-        skip = False
-        if existing:  #: ESRI's content.search is fuzzy, need to check against each item.title
-            for item in existing:
-                if item.title == item_name:
-                    skip = True
-                    print(f'new title: {item_name}')
-                    log_entry = [item_title, f'{feature_class_name} already published in AGOL as {item_name}: {item.itemid}']
-                    print(f'{feature_class_name} already published in AGOL as {item.title}: {item.itemid}')
-                    log.append(log_entry)
-        if skip:
+        if progress.reached(feature_class_name, 'uploaded'):
+            #: Published by a previous run; the item in the index is ours
+            to_stage.append([feature_class_name, item_title, source, action])
             continue
 
-        print('creating sd')
-        sd_path = create_service_definition(layer_info, sde_path, 
-                                            temp_dir, project_path, 
-                                            map_name, describe)
+        item_name = agol_title(item_title)
+        existing = published.get(item_name)
+        for itemid in existing:
+            log_entry = [item_title, f'{feature_class_name} already published in AGOL as {item_name}: {itemid}']
+            print(f'{feature_class_name} already published in AGOL as {item_name}: {itemid}')
+            log.append(log_entry)
+            log_csv(log_entry, log_path)
+        if not existing:
+            to_stage.append([feature_class_name, item_title, source, action])
+
+    #: Index the user's groups and folders once so finalizing a layer doesn't
+    #: have to search for them, and make sure every destination in the csv
+    #: exists before anything is published; whatever has to be created is
+    #: listed first. After that a lookup never creates anything, so a
+    #: destination that's still missing fails its layer.
+    print('Indexing groups and folders...')
+    resolver = categories.CategoryResolver(gis)
+    destinations = []
+    for entry in to_stage:
+        try:
+            destinations.append(get_destination(entry))
+        except ValueError:
+            continue  #: get_info() fails the layer
+    resolver.prepare([group for group, _ in destinations],
+                     [folder for _, folder in destinations])
+    resolver.create = False
+
+    #: Layers whose staging results (if they needed any) are still good
+    #: from a previous run: {feature class name: stage_layer() results}
+    already_staged = {}
+    layer_infos = []
+    for feature_class_name, item_title, _, _ in to_stage:
+        artifacts = progress.artifacts(feature_class_name)
+        if progress.reached(feature_class_name, 'uploaded') or \
+           (progress.reached(feature_class_name, 'staged') and
+            (artifacts['is_table'] or os.path.exists(artifacts['sd_path']))):
+            already_staged[feature_class_name] = {
+                'is_table': artifacts.get('is_table', False),
+                'shape': artifacts.get('shape'),
+                'projected_path': artifacts.get('projected_path'),
+                'sd_path': artifacts.get('sd_path'),
+                'error': None}
+            continue
 
-        info_list = [feature_class_name, item_title, source, action]
-        item_info = get_info(info_list, generic_terms_of_use)
-        item_id = upload_layer(gis, sd_path, item_info, protect=True)
+        projected = artifacts.get('projected_path')
+        if projected and not arcpy.Exists(projected):
+            projected = None
+        layer_infos.append({'fc_name': feature_class_name, 'title': item_title,
+                            'projected': projected})
+
+    #: Project and stage the layers, either one at a time in this process or
+    #: in a pool of worker processes. Either way the results come back in csv
+    #: order.
+    pool = None
+    staging_session = None
+    cache_dir = projection_cache_dir if args.projection_cache else None
+    if args.stage_workers > 1:
+        pool = multiprocessing.Pool(args.stage_workers, init_staging_worker,
+                                    (temp_dir, project_path, cache_dir,
+                                     timing.timer.run))
+        staged_layers = pool.imap(stage_layer_in_worker, layer_infos)
+    elif layer_infos:
+        staging_session = project_session.PublishingSession(project_path,
+                                                            map_name,
+                                                            args.save_every)
+        cache = projection_cache.ProjectionCache(cache_dir) if cache_dir else None
+        staged_layers = (stage_layer(layer_info, sde_path, temp_dir,
+                                     staging_session, cache)
+                         for layer_info in layer_infos)
+
+    #: Cache results from every process staging layers
+    projections = []
+
+
+    def staged_jobs():
+        for feature_class_name, item_title, source, action in to_stage:
+            if feature_class_name in already_staged:
+                staged = already_staged[feature_class_name]
+                print(f'\n {feature_class_name} staged in a previous run')
+            else:
+                try:
+                    staged = next(staged_layers)
+                except Exception as error:
+                    #: ie an error outside stage_layer's handling in a worker;
+                    #: pool.imap still has the results for the other layers
+                    traceback.print_exc()
+                    staged = {'is_table': False, 'shape': None,
+                              'projected_path': None, 'projection': None,
+                              'sd_path': None,
+                              'error': f'{type(error).__name__}: {error}'.replace(',', ';')}
+                timing.timer.add(staged.pop('spans', []))
+                if staged['projection']:
+                    projections.append(staged['projection'])
+                if staged['projected_path']:
+                    progress.record(feature_class_name, 'projected',
+                                    projected_path=staged['projected_path'])
+                if not staged['error']:
+                    progress.record(feature_class_name, 'staged',
+                                    is_table=staged['is_table'],
+                                    shape=staged['shape'],
+                                    sd_path=staged['sd_path'])
+                print(f'\n Staged {feature_class_name}')
+            yield {'name': feature_class_name,
+                   'entry': [feature_class_name, item_title, source, action],
+                   'staged': staged,
+                   'error': staged['error'],
+                   'item_id': None,
+                   'log_entry': None}
+
+    #: Enough threads for every upload worker to finalize a layer at once
+    item_finalizer = finalizer.ItemFinalizer(5 * args.upload_workers)
+
+    def upload_job(job):
+        '''Upload and finalize a staged layer'''
+        feature_class_name, item_title, source, action = job['entry']
 
-        shape = describe['shapeType'].lower()
+        #: Check if it's a table, skip if true
+        if job['staged']['is_table']:
+            print(f'{feature_class_name} is a table; not uploading')
+            job['log_entry'] = [item_title, 'Table: not uploaded']
+            return
+
+        item_name = agol_title(item_title)
+        artifacts = progress.artifacts(feature_class_name)
+        if progress.reached(feature_class_name, 'finalized'):
+            print(f'{feature_class_name} published in a previous run')
+            job['item_id'] = artifacts['item_id']
+            job['log_entry'] = artifacts['log_entry']
+            return
+
+        #: Another row in this run may have published (or be publishing) the
+        #: same title; reserving it is atomic with the check
+        if not progress.reached(feature_class_name, 'uploaded'):
+            if not published.reserve(item_name):
+                existing = published.get(item_name) or ['(being published by another row)']
+                print(f'{feature_class_name} already published in AGOL as {item_name}: {existing[0]}')
+                job['log_entry'] = [item_title, f'{feature_class_name} already published in AGOL as {item_name}: {existing[0]}']
+                return
+
+        try:
+            item_info = get_info(job['entry'], generic_terms_of_use, resolver)
+            if progress.reached(feature_class_name, 'uploaded'):
+                print(f'\n Finalizing {feature_class_name} published in a previous run')
+                published_item = gis.content.get(artifacts['item_id'])
+                sd_item = gis.content.get(artifacts['sd_item_id'])
+            else:
+                print(f'\n Uploading {feature_class_name}')
+                sd_item, published_item = publish_layer(gis, job['staged']['sd_path'])
+                progress.record(feature_class_name, 'uploaded',
+                                item_id=published_item.itemid,
+                                sd_item_id=sd_item.itemid)
+                published.add(item_name, published_item.itemid)
+            finalize_layer(published_item, sd_item, item_info, protect=True,
+                           item_finalizer=item_finalizer)
+        except arcpy.ExecuteError:
+            message = arcpy.GetMessages()
+            print(message)
+            job['error'] = message.replace(',', ';')
+            return
+        finally:
+            #: Only still reserved if publishing failed
+            published.release(item_name)
+
+        item_id = published_item.itemid
+        shape = job['staged']['shape']
         dash_name = item_title.replace(' ', '-').lower()
         endpoint = f'https://opendata.gis.utah.gov/datasets/{dash_name}'
         data_layer = feature_class_name.partition('.')[2]  #: layername for stewardship doc
 
         #: Log: AGOL title, operation, SGID name for stewardship doc, 
         #:      description, source/credit, shape type, endpoint, AGOL item ID
-        log_entry = [item_title, action, data_layer, item_info['description'],
-                     item_info['credits'], shape, endpoint, item_id]
-        log.append(log_entry)
-        updated_rows[feature_class_name] = log_gsheets(log_entry, 
-                                                       gsheet_auth, 
-                                                       (stewardship_sheet_key, 
-                                                            agol_sheet_key))
-        
+        job['item_id'] = item_id
+        job['log_entry'] = [item_title, action, data_layer, item_info['description'],
+                            item_info['credits'], shape, endpoint, item_id]
+        progress.record(feature_class_name, 'finalized', item_id=item_id,
+                        log_entry=job['log_entry'])
 
         #: Delete files from the scratch folder
         # sddraft = sd_path + 'draft'
         # os.remove(sd_path)
         # os.remove(sddraft)
-    except arcpy.ExecuteError:
-        message = arcpy.GetMessages()
-        print(message)
-        log_entry = [item_title, message.replace(',', ';')]
-        log.append(log_entry)
-    
-    except RuntimeError as error:
-        log_entry = [item_title, str(error)]
-        print(f'Error with {item_title}:')
-        traceback.print_exc()
 
+    def log_job(job):
+        '''Log a layer to the Google sheets (if published) and the log csv,
+        whether or not it was successful'''
+        feature_class_name, item_title, _, _ = job['entry']
+        try:
+            if job['error']:
+                job['log_entry'] = [item_title, job['error']]
+                progress.fail(feature_class_name, job['error'])
+            elif job['item_id']:  #: Published
+                updated_rows[feature_class_name] = log_gsheets(job['log_entry'], session)
+                #: Journaled as logged once the session sends the batch
+                session.layer_logged(feature_class_name)
+        finally:
+            log.append(job['log_entry'])
+            log_csv(job['log_entry'], log_path)
+
+        if not job['error'] and not job['item_id']:
+            #: Tables and duplicates have nothing waiting on the sheets
+            progress.record(feature_class_name, 'logged')
+
+    #: Stage layer N+1 while layer N uploads and layer N-1 is logged. Whatever
+    #: happens, the queued sheet changes are sent and the sessions closed.
+    try:
+        done = pipeline.run(staged_jobs(),
+                     [pipeline.Stage('upload', upload_job, args.upload_workers),
+                      pipeline.Stage('log', log_job, args.log_workers, always=True)],
+                     args.queue_size)
+    except BaseException:
+        #: ie ctrl+c: don't wait for the workers to stage the rest
+        if pool:
+            pool.terminate()
+        raise
     finally:
-        log_csv(log_entry, log_path)
+        #: Send whatever's left since the last batch
+        session.flush()
+        progress.close()
+        timing.print_summary()
+        timing.timer.close()
+
+        if pool:
+            pool.close()
+            pool.join()
+        if staging_session:
+            staging_session.close()
 
-# pprint.pprint(updated_rows)
+    if projections:
+        print(projection_cache.summary(projections))
 
-try:
-    shutil.rmtree(temp_dir)
-except PermissionError:
-    print(f'Could not remove temporary directory {temp_dir}. Please delete manually.')
+    # pprint.pprint(updated_rows)
+
+    failed = [job for job in done if job['error']]
+    if failed:
+        print(f'{len(failed)} layers failed. Keeping {temp_dir} so they can be '
+              f'retried with --resume.')
+        return
+
+    try:
+        shutil.rmtree(temp_dir)
+    except PermissionError:
+        print(f'Could not remove temporary directory {temp_dir}. Please delete manually.')
 
 
+if __name__ == '__main__':
+    main()
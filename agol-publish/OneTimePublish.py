@@ -7,10 +7,17 @@ import sys
 import arcgis
 import arcpy
 import pydash
-import gspread
-from oauth2client.service_account import ServiceAccountCredentials
 from tqdm import tqdm
 
+import buffered_sheet
+import categories
+import finalizer
+import projection_cache
+import thumbnails
+import timing
+import uploads
+import writeback
+
 owner = sys.argv[1]
 password = sys.argv[2]
 share = sys.argv[3]
@@ -36,6 +43,12 @@ map_name = 'Publishing'
 transformation = 'NAD_1983_to_WGS_1984_5'
 drafts_folder = join(fgdb_folder, 'drafts')
 metadata_file_path = join(current_folder, 'metadata.json')
+#: published ids are written back to AGOLItems in batches of this many layers
+#: (or after this many seconds) in one edit session
+write_back_every = 10
+write_back_seconds = 300
+
+timing.start('OneTimePublish', timing.default_path('OneTimePublish'))
 
 gis = arcgis.gis.GIS(username=owner, password=password)
 pro_project = arcpy.mp.ArcGISProject(pro_project_path)
@@ -45,6 +58,18 @@ for cat_map in pro_project.listMaps():
 temp_map = maps['Temp']
 web_mercator = arcpy.SpatialReference(3857)
 published_items = []
+item_finalizer = finalizer.ItemFinalizer()
+#: unsent rows are kept on the share, out of the repo
+sheet_client = buffered_sheet.SheetClient('deq-enviro-key.json', '1MBTwZg7pqpD9noFNAHU8d76EfXD3hMffmbjAHBtkoyQ',
+                                  join(fgdb_folder, 'published_rows.jsonl'))
+#: commits any ids a crashed run left queued, so they aren't published again.
+#: The queue is kept on the share with the fgdbs, out of the repo.
+id_writer = writeback.ItemIdWriter(sgid_write, agol_items_table,
+                                   join(fgdb_folder, 'write_back_queue.jsonl'),
+                                   write_back_every, write_back_seconds)
+thumbnail_queue = thumbnails.ThumbnailQueue(gis, thumbnails.default_retry_path)
+#: reuse projections in the category fgdbs until their sources change
+cache = projection_cache.ProjectionCache(fgdb_folder)
 metadata_lookup = None
 with open(metadata_file_path, 'r') as file:
   metadata_lookup = json.loads(file.read())
@@ -61,30 +86,45 @@ def cleanup():
   rmtree(drafts_folder)
   mkdir(drafts_folder)
 
-def import_data(sgid_table, fgdb_folder, fgdb, name, is_table):
-  output_table = join(fgdb_folder, fgdb, name)
-
+def prepare_category(category):
+  #: once per category batch: make sure its fgdb exists and index its map's
+  #: layers and tables by name so finding or adding each layer is a lookup
+  fgdb = f'{category}.gdb'
   if not arcpy.Exists(join(fgdb_folder, fgdb)):
     print(f'creating {fgdb}')
     arcpy.management.CreateFileGDB(fgdb_folder, fgdb)
 
-  if not arcpy.Exists(output_table):
+  try:
+    add_map = maps[category]
+  except KeyError:
+    raise ValueError(f'ERROR: no map corresponding map found for {category}')
+
+  layer_index = {}
+  for layer in add_map.listLayers() + add_map.listTables():
+    layer_index[layer.name] = layer
+
+  return fgdb, add_map, layer_index
+
+def import_data(sgid_table, fgdb_folder, fgdb, name, is_table):
+  #: the fgdb is created by prepare_category
+  output_table = join(fgdb_folder, fgdb, name)
+
+  def project(sgid_table, output_table):
+    if arcpy.Exists(output_table):
+      print(f'replacing out of date {output_table}')
+      arcpy.management.Delete(output_table)
+
     print('importing/projecting data')
     if is_table:
       arcpy.management.Copy(sgid_table, output_table)
     else:
       arcpy.management.Project(sgid_table, output_table, web_mercator, transformation)
 
-  return output_table
-
-def add_data_to_map(category, name, output_table, add_map):
-  existing_layers = add_map.listLayers()
-  existing_tables = add_map.listTables()
+  return cache.fetch(sgid_table, output_table, project)
 
-  share_layer = None
-  for layer in existing_layers + existing_tables:
-    if layer.name == name:
-      share_layer = layer
+def add_data_to_map(name, output_table, add_map, layer_index, is_table):
+  #: the project is saved once per category batch instead of for every layer
+  share_layer = layer_index.get(name)
 
   if share_layer is None:
     print(f'adding data to map: {output_table}')
@@ -94,35 +134,31 @@ def add_data_to_map(category, name, output_table, add_map):
       share_layer = add_map.addTable(new_layer)[0]
     else:
       share_layer = add_map.addLayer(new_layer, 'BOTTOM')[0]
-
-    pro_project.save()
+    layer_index[name] = share_layer
 
   return share_layer
 
 def publish_to_agol(share_layer, category, item_name, add_map):
-  global missing_thumbnails
   print(f'publishing {item_name} to AGOL')
   draft_path = join(drafts_folder, f'{share_layer.name}.sddraft')
   sd_path = draft_path[:-5]
   category_tag = pydash.title_case(category)
 
   print('staging')
-  sharing_draft = add_map.getWebLayerSharingDraft('HOSTING_SERVER', 'FEATURE', share_layer.name, [share_layer])
-  sharing_draft.exportToSDDraft(draft_path)
-  arcpy.server.StageService(draft_path, sd_path)
+  with timing.span('stage', layer=share_layer.name):
+    sharing_draft = add_map.getWebLayerSharingDraft('HOSTING_SERVER', 'FEATURE', share_layer.name, [share_layer])
+    sharing_draft.exportToSDDraft(draft_path)
+    arcpy.server.StageService(draft_path, sd_path)
 
   print('uploading')
-  source_item = gis.content.add({}, data=sd_path)
-  source_item.protect()
-  source_item.move(category_tag)
+  with timing.span('upload', layer=share_layer.name):
+    source_item = uploads.upload_item(gis, sd_path)
 
   print('publishing feature service')
-  item = source_item.publish()
-  item.protect()
-  item.move(category_tag)
+  with timing.span('publish', layer=share_layer.name, item=source_item.id):
+    item = source_item.publish()
   published_items.append((item_name, item.id))
 
-  print('updating feature service item properties')
   tags = f'AGRC,SGID,{category_tag}'
   metadata = metadata_lookup[share_layer.name]
 
@@ -139,28 +175,18 @@ def publish_to_agol(share_layer, category, item_name, add_map):
     'tags': tags,
     'title': item_name
   })
-  success = item.update(metadata)
-  if not success:
-    raise Error('item update was not successful!')
-  group = gis.groups.search(query=f'title: "Utah SGID {category_tag}" AND owner: "{owner}"')[0]
-  item.share(everyone=True, groups=[group.id])
+  group_id, folder = resolver.resolve(category_tag)
 
-  print('creating thumbnail')
-  try:
-    item.create_thumbnail()
-  except Exception as e:
-    print(e)
-    print('retrying thumbnail')
-    try:
-      item.create_thumbnail()
-    except Exception as e:
-      print(e)
-      print('error creating thumbnail, skipping')
-      missing_thumbnails.append(item.id)
-
-  #: enable "Allow others to export to different formats" checkbox
-  manager = arcgis.features.FeatureLayerCollection.fromitem(item).manager
-  manager.update_definition({ 'capabilities': 'Query,Extract' })
+  #: one update for the properties, then protection, moves, sharing, and the
+  #: "Allow others to export to different formats" checkbox all at once
+  print('finalizing feature service and service definition items')
+  item_finalizer.finalize(item, source_item, properties=metadata,
+                          groups=[group_id], everyone=True, org=False,
+                          folder=folder, protect=True, protect_sd=True,
+                          capabilities='Query,Extract')
+
+  #: created in the background; failures are saved for thumbnails.py to retry
+  thumbnail_queue.submit(item)
 
   print(f'{item_name} published as: {source_item.id} (service def) & {item.id} (feature layer)')
 
@@ -172,59 +198,78 @@ cleanup()
 sql = (None, 'ORDER BY TABLENAME')
 query = 'AGOL_ITEM_ID IS NULL'
 
-missing_thumbnails = []
 with arcpy.da.SearchCursor(agol_items_table, ['TABLENAME', 'AGOL_PUBLISHED_NAME'], query, sql_clause=sql) as cursor:
-  for table, item_name in tqdm(cursor):
-    sgid_table = join(sgid, table)
+  to_publish = list(cursor)
 
-    try:
+#: publish category by category so that each category's fgdb and map are
+#: prepared and the project saved once per batch. Tables and missing sources
+#: are skipped, so they're left out of the batches.
+batches = {}
+for table, item_name in tqdm(to_publish):
+  sgid_table = join(sgid, table)
+
+  try:
+    with timing.span('describe', layer=table):
       describe = arcpy.da.Describe(sgid_table)
-    except:
-      print(f'{sgid_table} does not exist!!!!!!!')
-      continue
-    is_table = describe['datasetType'] == 'Table'
+  except:
+    print(f'{sgid_table} does not exist!!!!!!!')
+    continue
+  is_table = describe['datasetType'] == 'Table'
 
-    if is_table:
-      continue
+  if is_table:
+    continue
 
-    print(table)
-    _, category, name = table.split('.')
-    fgdb = f'{category}.gdb'
+  batches.setdefault(table.split('.')[1], []).append((table, item_name, sgid_table))
 
-    output_table = import_data(sgid_table, fgdb_folder, fgdb, name, is_table)
+#: look up (or create) the group and folder of every category that has layers
+#: to publish up front
+print('resolving category groups and folders')
+resolver = categories.CategoryResolver(gis, owner)
+resolver.prepare_categories(pydash.title_case(category) for category in batches)
 
-    try:
-      add_map = maps[category]
-    except KeyError:
-      raise Error(f'ERROR: no map corresponding map found for {category}')
+progress = tqdm(total=sum(len(feature_classes) for feature_classes in batches.values()))
+for category, feature_classes in batches.items():
+  print(f'publishing {len(feature_classes)} layers in {category}')
+  with timing.span('prepare category', category=category):
+    fgdb, add_map, layer_index = prepare_category(category)
 
-    share_layer = add_data_to_map(category, name, output_table, add_map)
+  for table, item_name, sgid_table in feature_classes:
+    print(table)
+    name = table.split('.')[2]
 
-    published_id = publish_to_agol(share_layer, category, item_name, add_map)
+    with timing.span('project', layer=table) as span:
+      output_table = import_data(sgid_table, fgdb_folder, fgdb, name, False)
+      span['cache'] = cache.results[sgid_table]
 
-    share_layer.visible = False
+    with timing.span('add to map', layer=table):
+      share_layer = add_data_to_map(name, output_table, add_map, layer_index, False)
 
-    #: this is so that edits are saved with each successful publish
-    with arcpy.da.Editor(sgid_write):
-      update_query = f'TABLENAME = \'{table}\''
-      with arcpy.da.UpdateCursor(agol_items_table, ['AGOL_ITEM_ID'], update_query) as update_cursor:
-        for row in update_cursor:
-          update_cursor.updateRow((published_id,))
+    with timing.span('publish to agol', layer=table):
+      published_id = publish_to_agol(share_layer, category, item_name, add_map)
 
-    #: reauthorize gspread for each publish to make sure that the auth doesn't time out
-    scope = ['https://spreadsheets.google.com/feeds',
-            'https://www.googleapis.com/auth/drive']
+    share_layer.visible = False
+
+    #: queued on disk right away so a crash can't lose it; written in batches
+    id_writer.record(table, published_id)
 
-    credentials = ServiceAccountCredentials.from_json_keyfile_name('deq-enviro-key.json', scope)
-    gc = gspread.authorize(credentials)
+    #: buffered and sent in batches; the token is refreshed only when it's about to expire
+    sheet_client.append([item_name, published_id, f'https://utah.maps.arcgis.com/home/item.html?id={published_id}'])
+    progress.update()
 
-    sheet = gc.open_by_key('1MBTwZg7pqpD9noFNAHU8d76EfXD3hMffmbjAHBtkoyQ').get_worksheet(0)
-    sheet.append_row([item_name, published_id, f'https://utah.maps.arcgis.com/home/item.html?id={published_id}'])
+  with timing.span('save project', category=category):
+    pro_project.save()
 
+progress.close()
+id_writer.commit()
+sheet_client.flush()
+print('waiting for thumbnails')
+missing_thumbnails = thumbnail_queue.close()
 
+timing.print_summary()
+print(projection_cache.summary(cache.results.values()))
 print('published item ids:')
 for title, id in published_items:
   print(f'{title},{id}')
-print('items with missing thumbnails:')
+print(f'items with missing thumbnails (retry with thumbnails.py {owner}):')
 for id in missing_thumbnails:
   print(id)
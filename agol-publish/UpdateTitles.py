@@ -17,9 +17,12 @@ from os.path import join
 import sys
 from tqdm import tqdm
 
+import timing
+
 
 agol_items_table_name = 'SGID.META.AGOLItems'
 
+timing.start('UpdateTitles', timing.default_path('UpdateTitles'))
 gis = arcgis.gis.GIS(username=sys.argv[1], password=sys.argv[2])
 
 agol_items_table = join(sys.argv[3], agol_items_table_name)
@@ -29,17 +32,21 @@ query = 'AGOL_ITEM_ID IS NOT NULL AND AGOL_ITEM_ID <> \'EXTERNAL\' AND AGOL_PUBL
 with arcpy.da.SearchCursor(agol_items_table, ['AGOL_ITEM_ID', 'AGOL_PUBLISHED_NAME'], query) as cursor:
   for item_id, name in tqdm(cursor):
     try:
-      item = arcgis.gis.Item(gis, item_id)
+      with timing.span('get item', item=item_id):
+        item = arcgis.gis.Item(gis, item_id)
 
       if item.title != name:
         print(f'{item.title} ({item_id}) -> {name}')
-        item.update({'title': name})
+        with timing.span('update title', item=item_id):
+          item.update({'title': name})
 
     except Exception as e:
       message = f'Error with {name} ({item_id}): {e}'
       errors.append(message)
       print(message)
 
+timing.print_summary()
+
 if len(errors) > 0:
   print('Errors:')
   for e in errors:
@@ -0,0 +1,111 @@
+#!/usr/bin/env python
+# * coding: utf8 *
+'''
+buffered_sheet.py
+
+Append rows to a Google sheet with gspread in batches, keeping unsent rows in
+a local file so a crash can't lose them. Used by OneTimePublish; NightStocker
+uses the pygsheets client in sheets.py, so the two scripts each only need
+their own Google client.
+'''
+
+import datetime
+import threading
+import time
+
+import gspread
+import httplib2
+from oauth2client.service_account import ServiceAccountCredentials
+
+import durable
+import timing
+
+
+class SheetClient:
+    '''Append rows to one worksheet with gspread without re-authorizing for
+    each row. The service account token is only refreshed when it's about to
+    expire, and rows are buffered in a file and sent in batches so a crash
+    can't lose them.
+
+    Parameters:
+    key_file: path to the service account's json key file
+    sheet_key: key of the Google sheet to append to
+    buffer_path: file to keep unsent rows in; rows left there by an earlier
+                 run are sent with the next batch
+    worksheet: index of the worksheet in the sheet
+    flush_every: send the buffered rows once there are this many
+    flush_seconds: send the buffered rows when one is added this long after
+                   the last batch, even if there are fewer than flush_every
+    refresh_margin: refresh the token when it expires in less than this many
+                    seconds
+    '''
+
+    scope = ['https://spreadsheets.google.com/feeds',
+             'https://www.googleapis.com/auth/drive']
+
+    def __init__(self, key_file, sheet_key, buffer_path, worksheet=0,
+                 flush_every=10, flush_seconds=300, refresh_margin=300):
+        self.sheet_key = sheet_key
+        self.worksheet_index = worksheet
+        self.buffer_path = buffer_path
+        self.flush_every = flush_every
+        self.flush_seconds = flush_seconds
+        self.refresh_margin = datetime.timedelta(seconds=refresh_margin)
+
+        #: Reentrant so append() can flush while holding it
+        self.lock = threading.RLock()
+
+        self.credentials = ServiceAccountCredentials.from_json_keyfile_name(key_file, self.scope)
+        self.client = None
+        self.worksheet = None
+
+        self.buffer = durable.JsonLines(buffer_path)
+        self.rows = list(self.buffer.records)
+        if self.rows:
+            print(f'{len(self.rows)} unsent rows from an earlier run in {buffer_path}')
+        self.last_flush = time.monotonic()
+
+    def _connect(self):
+        '''Authorize and open the worksheet the first time, and refresh the
+        token when it's close to expiring.
+        '''
+        if self.client is None:
+            self.client = gspread.authorize(self.credentials)
+            self.worksheet = self.client.open_by_key(self.sheet_key).get_worksheet(self.worksheet_index)
+            return
+
+        expiry = self.credentials.token_expiry  #: naive UTC
+        if expiry is None or expiry - datetime.datetime.utcnow() < self.refresh_margin:
+            print('refreshing Google sheets token')
+            self.credentials.refresh(httplib2.Http())
+            self.client.login()  #: Picks up the new token
+
+    def append(self, values):
+        '''Buffer a row, sending the buffer if it's time.
+        '''
+        with self.lock:
+            self.buffer.append(values)
+            self.rows.append(values)
+
+            if len(self.rows) >= self.flush_every or \
+               time.monotonic() - self.last_flush >= self.flush_seconds:
+                self.flush()
+
+    def flush(self):
+        '''Send all the buffered rows in one append_rows call and clear the
+        buffer.
+
+        Note: if the process dies after the rows are sent but before the
+        buffer file is cleared, they will be sent again by the next run.
+        '''
+        with self.lock, timing.span('sheet append', rows=len(self.rows)):
+            self.last_flush = time.monotonic()
+            if not self.rows:
+                return
+
+            self._connect()
+            self.worksheet.append_rows(self.rows)
+            print(f'Sent {len(self.rows)} rows to sheet {self.sheet_key}')
+
+            self.rows = []
+            self.buffer.clear()
@@ -0,0 +1,167 @@
+#!/usr/bin/env python
+# * coding: utf8 *
+'''
+categories.py
+
+Resolve the groups and folders that published items are shared with and moved
+to once per run instead of once per item. There are only a couple dozen SGID
+categories, so the owner's groups and folders are looked up in a single pass
+at startup and every item after that is a dictionary lookup.
+
+A group the owner doesn't have is looked for by title in the rest of the org
+before anything is created, and everything that is about to be created is
+listed first.
+'''
+
+import threading
+
+import timing
+
+#: Title of the group SGID items in a category are shared with
+sgid_group_title = 'Utah SGID {}'
+
+
+class CategoryResolver:
+    '''Group ids and folders by title for one AGOL user. Lookups are safe to
+    make from several threads at once.
+
+    Parameters:
+    gis: An ArcGIS API gis item.
+    owner: username owning the groups and folders; defaults to the logged in
+           user
+    create: if True, create groups and folders that don't exist yet (in the
+            org, for groups); otherwise a missing one raises a KeyError
+    '''
+
+    def __init__(self, gis, owner=None, create=True):
+        self.gis = gis
+        self.owner = owner or gis.users.me.username
+        self.create = create
+        self.lock = threading.Lock()
+
+        #: {title: group id}
+        self.groups = {}
+        #: {title: folder dict}; passing the dict to Item.move() saves it
+        #: looking up the folder's id by title
+        self.folders = {}
+
+        self._load()
+
+    def _load(self):
+        '''Index the owner's groups and folders (one request each).
+        '''
+        with timing.span('category index'):
+            for group in self.gis.groups.search(query=f'owner: "{self.owner}"',
+                                                max_groups=10000):
+                self.groups[group.title] = group.id
+            user = self.gis.users.get(self.owner)
+            for folder in user.folders:
+                self.folders[folder['title']] = folder
+
+    def _find_group(self, title):
+        '''Search the org for a group with exactly this title owned by anyone
+        (ie 'AGRC Shelf' belonging to another admin). Called with the lock
+        held.
+
+        returns: True if one was found and indexed
+        '''
+        with timing.span('group search', group=title):
+            found = [group for group in
+                     self.gis.groups.search(query=f'title:"{title}"', max_groups=100)
+                     if group.title == title]
+        if not found:
+            return False
+        print(f'using group {title} owned by {found[0].owner}')
+        self.groups[title] = found[0].id
+        return True
+
+    def prepare(self, groups=(), folders=()):
+        '''The pre-pass: make sure each of the groups and folders exists so
+        later lookups never have to go to AGOL. Everything that has to be
+        created is listed before any of it is.
+
+        Parameters:
+        groups: group titles
+        folders: folder titles
+
+        raises: KeyError listing the missing groups and folders if the
+                resolver doesn't create them
+        '''
+        with self.lock:
+            new_groups = sorted(title for title in set(groups)
+                                if title not in self.groups and not self._find_group(title))
+            new_folders = sorted(title for title in set(folders)
+                                 if title not in self.folders)
+
+        if not new_groups and not new_folders:
+            return
+        if not self.create:
+            raise KeyError(f'Missing groups {new_groups} and folders {new_folders} '
+                           f'for {self.owner}')
+
+        if new_groups:
+            print(f'No group in the org has these titles; creating {len(new_groups)} '
+                  f'public groups owned by {self.owner}: {", ".join(new_groups)}')
+        if new_folders:
+            print(f'Creating {len(new_folders)} folders for {self.owner}: '
+                  f'{", ".join(new_folders)}')
+        with self.lock:
+            for title in new_groups:
+                self._create_group(title)
+        for title in new_folders:
+            self.folder(title)
+
+    def prepare_categories(self, categories):
+        '''prepare() the SGID group and folder for each category.
+
+        Parameters:
+        categories: category tags, ie 'Boundaries' or 'Water'
+        '''
+        categories = set(categories)
+        self.prepare([sgid_group_title.format(category) for category in categories],
+                     categories)
+
+    def _create_group(self, title):
+        '''Create a public group. Called with the lock held.
+        '''
+        print(f'creating public group {title} owned by {self.owner}')
+        with timing.span('create group', group=title):
+            group = self.gis.groups.create(title=title, tags='AGRC,SGID',
+                                           access='public')
+        self.groups[title] = group.id
+
+    def group_id(self, title):
+        '''returns: the id of the group with this title, preferring the
+                 owner's own
+        '''
+        with self.lock:
+            if title not in self.groups and not self._find_group(title):
+                if not self.create:
+                    raise KeyError(f'No group titled {title} in the org')
+                print(f'No group in the org is titled {title}')
+                self._create_group(title)
+            return self.groups[title]
+
+    def folder(self, title):
+        '''returns: the owner's folder with this title, as a dict with its id
+                 and title
+        '''
+        with self.lock:
+            if title not in self.folders:
+                if not self.create:
+                    raise KeyError(f'No folder titled {title} owned by {self.owner}')
+                print(f'creating folder {title}')
+                with timing.span('create folder', folder=title):
+                    folder = self.gis.content.create_folder(title, self.owner)
+                self.folders[title] = folder
+            return self.folders[title]
+
+    def resolve(self, category):
+        '''Look up where an SGID item in a category goes.
+
+        Parameters:
+        category: category tag, ie 'Boundaries'
+
+        returns: (group id, folder dict)
+        '''
+        return self.group_id(sgid_group_title.format(category)), self.folder(category)
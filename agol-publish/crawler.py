@@ -0,0 +1,227 @@
+#!/usr/bin/env python
+# * coding: utf8 *
+'''
+crawler.py
+
+Lazily page through AGOL search results without the 1000 item cap of
+content.search(max_items=1000) and user.items(folder, 1000). The next page is
+requested in the background while the current one is being consumed.
+'''
+
+import concurrent.futures
+import threading
+
+import arcgis
+
+import timing
+
+
+#: The most results AGOL returns for one search query
+result_cap = 10000
+
+#: Queries (including any type clause) that had more than result_cap results
+_truncated = set()
+
+
+def truncated(query, item_type=None):
+    '''returns: True if a search_results() call for this query had more results
+             than AGOL would return
+    '''
+    if item_type:
+        query = f'{query} AND type:"{item_type}"'
+    return query in _truncated
+
+
+def paged(fetch_page, prefetch=True):
+    '''Yield every result from a paged REST listing, one page at a time.
+
+    Parameters:
+    fetch_page: function taking a 1-based start index and returning a tuple
+                of (list of results, next start index); next start is -1 (or
+                any value < 1) after the last page
+    prefetch: if True, fetch the next page on a background thread while the
+              current page is being consumed
+
+    returns: generator of results
+    '''
+    if not prefetch:
+        start = 1
+        while start > 0:
+            results, start = fetch_page(start)
+            yield from results
+        return
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=1) as pool:
+        pending = pool.submit(fetch_page, 1)
+        while pending:
+            results, next_start = pending.result()
+            pending = pool.submit(fetch_page, next_start) if next_start > 0 else None
+            yield from results
+
+
+def search_results(gis, query, item_type=None, page_size=100, prefetch=True):
+    '''Lazily search the portal, yielding the raw item json of each result.
+
+    Parameters:
+    gis: An ArcGIS API gis item.
+    query: AGOL search query, ie 'owner:UtahAGRC'
+    item_type: if specified, only items of this exact type are returned
+               ('Feature Service' for hosted feature layers). The type is
+               added to the query so the server does the filtering; results
+               are checked again because the server's type match is fuzzy.
+    page_size: number of results per request (max 100)
+    prefetch: if True, request the next page while this one is consumed
+
+    returns: generator of item dictionaries
+
+    Note: AGOL won't page past the 10,000th result of a single query. A
+    warning is printed when a query has more results than that, and
+    truncated(query) is True afterwards.
+    '''
+    if item_type:
+        query = f'{query} AND type:"{item_type}"'
+
+    def fetch_page(start):
+        with timing.span('search page', query=query, start=start):
+            response = gis._con.post('search', {
+                'q': query,
+                'start': start,
+                'num': page_size,
+                #: A stable sort keeps pages from shifting under us
+                'sortField': 'created',
+                'sortOrder': 'asc',
+                'f': 'json'
+            })
+        if start == 1 and response.get('total', 0) > result_cap:
+            _truncated.add(query)
+            print(f'WARNING: {query} has {response["total"]} results but AGOL '
+                  f'only returns the first {result_cap}; the rest are skipped')
+        return response['results'], response['nextStart']
+
+    for result in paged(fetch_page, prefetch):
+        if item_type and result['type'] != item_type:
+            continue
+        yield result
+
+
+def search_items(gis, query, item_type=None, page_size=100, prefetch=True):
+    '''Lazily search the portal for items. See search_results() for the
+    parameters.
+
+    returns: generator of arcgis.gis.Item objects
+    '''
+    for result in search_results(gis, query, item_type, page_size, prefetch):
+        yield arcgis.gis.Item(gis, result['id'], result)
+
+
+def user_items(gis, username, item_type=None, page_size=100, prefetch=True):
+    '''Lazily crawl all of a user's items along with the folder each is in.
+
+    Parameters:
+    gis: An ArcGIS API gis item.
+    username: AGOL user whose content should be crawled
+    item_type: if specified, only items of this exact type are returned
+    page_size: number of results per request (max 100)
+    prefetch: if True, request the next page while this one is consumed
+
+    returns: generator of (arcgis.gis.Item, folder title) tuples; folder title
+             is None for the user's root folder
+    '''
+    user = gis.users.get(username)
+    folder_titles = {folder['id']: folder['title'] for folder in user.folders}
+
+    for result in search_results(gis, f'owner:{username}', item_type, page_size, prefetch):
+        item = arcgis.gis.Item(gis, result['id'], result)
+        yield item, folder_titles.get(result.get('ownerFolder'))
+
+
+class TitleIndex:
+    '''An exact title -> item id(s) index of items, built from one crawl of the
+    portal instead of a fuzzy search per title. Safe to update from several
+    threads as new items are published.
+
+    Publishing threads should reserve() a title before publishing it and add()
+    the new item (or release() the title) afterwards, so that two rows with the
+    same title can't both be published.
+
+    If the query has more results than AGOL returns (see search_results()),
+    titles missing from the index are looked up with a search of their own.
+
+    Parameters:
+    gis: An ArcGIS API gis item.
+    query: AGOL search query for the items to index, ie 'orgid:<org id>'
+    item_type: if specified, only items of this exact type are indexed
+    page_size: number of results per request (max 100)
+    prefetch: if True, request the next page while this one is consumed
+    '''
+
+    def __init__(self, gis, query, item_type=None, page_size=100, prefetch=True):
+        self.gis = gis
+        self.query = query
+        self.item_type = item_type
+        self.lock = threading.Lock()
+
+        #: {title: [itemid, ...]}
+        self.titles = {}
+        #: titles being published right now
+        self.reserved = set()
+        for result in search_results(gis, query, item_type, page_size, prefetch):
+            self.titles.setdefault(result['title'], []).append(result['id'])
+        self.complete = not truncated(query, item_type)
+        #: titles looked up on their own because the index is incomplete
+        self.searched = set()
+
+    def _search(self, title):
+        '''Look up a title the crawl may have missed (only when the index is
+        incomplete). Called with the lock held.
+        '''
+        if self.complete or title in self.searched:
+            return
+        escaped = title.replace('"', '\\"')
+        for result in search_results(self.gis, f'{self.query} AND title:"{escaped}"',
+                                     self.item_type, prefetch=False):
+            ids = self.titles.setdefault(result['title'], [])
+            if result['id'] not in ids:
+                ids.append(result['id'])
+        self.searched.add(title)
+
+    def get(self, title):
+        '''returns: list of ids of the items with exactly this title
+        '''
+        with self.lock:
+            self._search(title)
+            return list(self.titles.get(title, []))
+
+    def reserve(self, title):
+        '''Claim a title for publishing.
+
+        returns: True if no item has the title and no other thread has it
+                 reserved; False otherwise
+        '''
+        with self.lock:
+            self._search(title)
+            if self.titles.get(title) or title in self.reserved:
+                return False
+            self.reserved.add(title)
+            return True
+
+    def release(self, title):
+        '''Give up a reservation without publishing (ie, publishing failed).
+        Does nothing if the title isn't reserved.
+        '''
+        with self.lock:
+            self.reserved.discard(title)
+
+    def add(self, title, itemid):
+        '''Add a newly published item to the index, filling its title's
+        reservation.
+        '''
+        with self.lock:
+            ids = self.titles.setdefault(title, [])
+            if itemid not in ids:
+                ids.append(itemid)
+            self.reserved.discard(title)
+
+    def __len__(self):
+        with self.lock:
+            return len(self.titles)
@@ -0,0 +1,73 @@
+#!/usr/bin/env python
+# * coding: utf8 *
+'''
+durable.py
+
+An append-only JSON lines file that survives crashes. Each record is synced to
+disk before append() returns, and opening the file again reads back every
+complete record and drops a last line left partial by a crash. Used by the
+publishing journal, the item id write back queue, and the buffered sheet rows.
+'''
+
+import json
+import os
+
+
+class JsonLines:
+    '''A JSON lines file of records.
+
+    Parameters:
+    path: path to the file
+    resume: if True, read the records already in the file (if any) and keep
+            appending to it; otherwise start a new, empty file
+
+    Not thread safe; callers appending from several threads need a lock.
+    '''
+
+    def __init__(self, path, resume=True):
+        self.path = path
+
+        #: The records that were in the file when it was opened
+        self.records = []
+
+        if resume and os.path.exists(path):
+            good = 0
+            with open(path, 'rb') as lines_file:
+                for line in lines_file:
+                    if not line.endswith(b'\n'):
+                        break
+                    try:
+                        self.records.append(json.loads(line))
+                    except ValueError:
+                        break
+                    good += len(line)
+
+            #: A line cut short by a crash was never recorded; drop it so new
+            #: records start on a line of their own
+            with open(path, 'r+b') as lines_file:
+                lines_file.truncate(good)
+            mode = 'a'
+        else:
+            mode = 'w'
+
+        self.file = open(path, mode)
+
+    def _sync(self):
+        self.file.flush()
+        os.fsync(self.file.fileno())
+
+    def append(self, record):
+        '''Add a record to the end of the file and sync it to disk.
+        '''
+        self.file.write(json.dumps(record) + '\n')
+        self._sync()
+
+    def clear(self):
+        '''Remove every record from the file.
+        '''
+        self.file.seek(0)
+        self.file.truncate()
+        self._sync()
+
+    def close(self):
+        self.file.close()
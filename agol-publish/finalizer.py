@@ -0,0 +1,133 @@
+#!/usr/bin/env python
+# * coding: utf8 *
+'''
+finalizer.py
+
+Finish setting up a newly published item in as few round trips as possible:
+one update for all of its properties, then sharing, delete protection, folder
+moves, and service capabilities at the same time.
+'''
+
+import concurrent.futures
+import time
+from collections import namedtuple
+
+import arcgis
+
+import timing
+
+#: How one finalize operation went.
+#: name: operation name, ie 'share' or 'move sd'
+#: ok: True if it succeeded
+#: seconds: how long it took
+#: error: the error message if it failed, otherwise None
+OperationResult = namedtuple('OperationResult', ['name', 'ok', 'seconds', 'error'])
+
+
+class FinalizeError(Exception):
+    '''One or more finalize operations failed. results holds every
+    operation's OperationResult.
+    '''
+
+    def __init__(self, results):
+        self.results = results
+        failed = '; '.join(f'{result.name}: {result.error}'
+                           for result in results if not result.ok)
+        super().__init__(f'finalize failed: {failed}')
+
+
+class ItemFinalizer:
+    '''Runs the post-publish operations for items. One finalizer can be
+    shared by several threads publishing at once.
+
+    Parameters:
+    workers: number of operations to run at the same time
+    '''
+
+    def __init__(self, workers=4):
+        self.pool = concurrent.futures.ThreadPoolExecutor(max_workers=workers)
+
+    @staticmethod
+    def _run(name, operation, item, parent=None):
+        start = time.perf_counter()
+        try:
+            with timing.span(f'finalize {name}', parent, item=item.itemid):
+                if operation() is False:  #: Item methods report some failures this way
+                    raise RuntimeError('operation was not successful')
+        except Exception as error:
+            return OperationResult(name, False, time.perf_counter() - start, str(error))
+        return OperationResult(name, True, time.perf_counter() - start, None)
+
+    def finalize(self, item, sd_item=None, properties=None, groups=None,
+                 everyone=True, org=True, folder=None, protect=True,
+                 protect_sd=False, capabilities=None, raise_errors=True):
+        '''Finalize a published item.
+
+        Parameters:
+        item: the published item
+        sd_item: the service definition item it was published from, moved
+                 (and protected) along with it
+        properties: dictionary of item properties (tags, description, title,
+                    etc) to set in a single update
+        groups: list of groups to share the item with
+        everyone: share with everyone
+        org: share with the organization
+        folder: folder to move the item (and sd_item) to, by title or as a
+                folder dict (see categories.CategoryResolver)
+        protect: turn on delete protection for the item
+        protect_sd: turn on delete protection for sd_item
+        capabilities: if specified, the feature service's new capabilities
+                      string, ie 'Query,Extract'
+        raise_errors: if True, raise a FinalizeError after all operations
+                      have run if any of them failed
+
+        returns: list of OperationResults, update first
+        '''
+        with timing.span('finalize', item=item.itemid) as record:
+            results = self._finalize(item, sd_item, properties, groups, everyone,
+                                     org, folder, protect, protect_sd,
+                                     capabilities, record['id'])
+
+        report = ', '.join(f'{result.name} {"ok" if result.ok else "FAILED"} '
+                           f'({result.seconds:.1f}s)' for result in results)
+        print(f'finalized {item.itemid}: {report}')
+
+        if raise_errors and not all(result.ok for result in results):
+            raise FinalizeError(results)
+
+        return results
+
+    def _finalize(self, item, sd_item, properties, groups, everyone, org,
+                  folder, protect, protect_sd, capabilities, span_id):
+        results = []
+
+        #: The update goes first by itself; the other operations don't
+        #: depend on it, but they shouldn't race it either
+        if properties:
+            results.append(self._run('update',
+                                     lambda: item.update(item_properties=properties),
+                                     item))
+
+        operations = []
+        if everyone or org or groups:
+            operations.append(('share', lambda: item.share(everyone=everyone, org=org,
+                                                           groups=groups)))
+        if protect:
+            operations.append(('protect', lambda: item.protect(enable=True)))
+        if sd_item and protect_sd:
+            operations.append(('protect sd', lambda: sd_item.protect(enable=True)))
+        if folder:
+            operations.append(('move', lambda: item.move(folder)))
+            if sd_item:
+                operations.append(('move sd', lambda: sd_item.move(folder)))
+        if capabilities:
+            def update_capabilities():
+                manager = arcgis.features.FeatureLayerCollection.fromitem(item).manager
+                return manager.update_definition({'capabilities': capabilities})
+            operations.append(('capabilities', update_capabilities))
+
+        futures = [self.pool.submit(self._run, name, operation, item, span_id)
+                   for name, operation in operations]
+        results.extend(future.result() for future in futures)
+
+        return results
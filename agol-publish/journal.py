@@ -0,0 +1,105 @@
+#!/usr/bin/env python
+# * coding: utf8 *
+'''
+journal.py
+
+A durable record of how far each layer has gotten through publishing so that
+an interrupted run can be resumed without redoing finished work. Every change
+is appended to a durable JSON lines file before the call returns; loading the
+file replays the lines to rebuild each layer's state.
+'''
+
+import datetime
+import threading
+
+import durable
+
+#: The stages a layer goes through, in order
+stages = ('projected', 'staged', 'uploaded', 'finalized', 'logged')
+
+
+class Journal:
+    '''A per-layer journal of completed stages and the artifacts (paths, item
+    ids, etc) each one produced.
+
+    Parameters:
+    path: path to the journal file
+    resume: if True, load the existing journal (if any) and keep adding to
+            it; otherwise start a new, empty journal
+    '''
+
+    def __init__(self, path, resume=False):
+        self.path = path
+        self.lock = threading.Lock()
+
+        #: Run-wide settings, like the temp dir holding the artifacts
+        self.run = {}
+
+        #: {layer: {'stage': last completed stage or None,
+        #:          'artifacts': {name: value}, 'error': last error or None}}
+        self.layers = {}
+
+        self.file = durable.JsonLines(path, resume)
+        for record in self.file.records:
+            self._apply(record)
+
+    def _apply(self, record):
+        if 'run' in record:
+            self.run.update(record['run'])
+            return
+
+        state = self.layers.setdefault(record['layer'],
+                                       {'stage': None, 'artifacts': {},
+                                        'error': None})
+        if record.get('stage'):
+            state['stage'] = record['stage']
+            state['error'] = None
+        state['artifacts'].update(record.get('artifacts', {}))
+        if record.get('error'):
+            state['error'] = record['error']
+
+    def _write(self, record):
+        record['time'] = datetime.datetime.now().isoformat()
+        with self.lock:
+            self._apply(record)
+            self.file.append(record)
+
+    def start(self, **settings):
+        '''Record run-wide settings (ie, temp_dir=...).
+        '''
+        self._write({'run': settings})
+
+    def record(self, layer, stage, **artifacts):
+        '''Record that a layer has finished a stage, along with the
+        artifacts it produced.
+        '''
+        if stage not in stages:
+            raise ValueError(f'Unknown stage: {stage}')
+        self._write({'layer': layer, 'stage': stage, 'artifacts': artifacts})
+
+    def fail(self, layer, error):
+        '''Record that a layer failed in the stage after its last completed
+        one. A resumed run will try that stage again.
+        '''
+        self._write({'layer': layer, 'error': error})
+
+    def stage(self, layer):
+        '''returns: the last stage the layer completed, or None
+        '''
+        with self.lock:
+            return self.layers.get(layer, {}).get('stage')
+
+    def reached(self, layer, stage):
+        '''returns: True if the layer has completed stage (or a later one)
+        '''
+        last = self.stage(layer)
+        return last is not None and stages.index(last) >= stages.index(stage)
+
+    def artifacts(self, layer):
+        '''returns: dict of all the artifacts recorded for the layer
+        '''
+        with self.lock:
+            return dict(self.layers.get(layer, {}).get('artifacts', {}))
+
+    def close(self):
+        self.file.close()
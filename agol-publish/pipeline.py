@@ -0,0 +1,112 @@
+#!/usr/bin/env python
+# * coding: utf8 *
+'''
+pipeline.py
+
+Run jobs through a series of stages connected by bounded queues so that the
+stages overlap: while one job is in the second stage, the next one can be in
+the first. Each stage gets its own number of worker threads.
+'''
+
+import queue
+import threading
+import traceback
+from collections import namedtuple
+
+import timing
+
+#: A step in a pipeline.
+#: name: stage name, used to label errors
+#: function: called with each job (a dictionary), which it updates in place
+#: workers: number of threads running this stage
+#: always: if True, the stage also gets jobs that failed in an earlier stage
+#:         (ie, for logging); otherwise failed jobs just pass through
+Stage = namedtuple('Stage', ['name', 'function', 'workers', 'always'])
+Stage.__new__.__defaults__ = (1, False)
+
+#: Put in a queue after the last job
+_finished = object()
+
+
+def run(jobs, stages, queue_size=2):
+    '''Push jobs through each of the stages in turn.
+
+    Parameters:
+    jobs: iterable of job dictionaries. It is consumed on the calling thread,
+          so it can be a generator that does work of its own (like staging)
+          and it will be held back whenever the first stage falls behind.
+    stages: list of Stages
+    queue_size: maximum number of jobs waiting in front of each stage
+
+    Each stage's work on a job is timed as a span named after the stage and
+    tagged with job['name'], if the job has one.
+
+    A stage function that raises marks the job as failed by setting
+    job['error'] to '<stage name>: <exception>'; later stages skip it unless
+    they are flagged always.
+
+    If jobs itself raises, no more jobs are taken from it. The jobs already
+    started still go through every stage, and a job named 'jobs' with the
+    error is added to the results, so the caller can finish up (flush logs,
+    close sessions) before reporting the failure.
+
+    returns: list of the jobs in the order they came out of the last stage
+    '''
+    queues = [queue.Queue(maxsize=queue_size) for _ in stages]
+    done = []
+    done_lock = threading.Lock()
+
+    def work(stage, inbox, outbox):
+        while True:
+            job = inbox.get()
+            if job is _finished:
+                #: Put it back so the stage's other workers see it too
+                inbox.put(_finished)
+                return
+
+            if stage.always or not job.get('error'):
+                try:
+                    with timing.span(stage.name, job=job.get('name')):
+                        stage.function(job)
+                except Exception as error:
+                    traceback.print_exc()
+                    job['error'] = f'{stage.name}: {error}'
+
+            if outbox:
+                outbox.put(job)
+            else:
+                with done_lock:
+                    done.append(job)
+
+    workers = []
+    for i, stage in enumerate(stages):
+        outbox = queues[i + 1] if i + 1 < len(stages) else None
+        threads = [threading.Thread(target=work, args=(stage, queues[i], outbox),
+                                    name=f'{stage.name}-{n}', daemon=True)
+                   for n in range(stage.workers)]
+        for thread in threads:
+            thread.start()
+        workers.append(threads)
+
+    jobs = iter(jobs)
+    while True:
+        try:
+            job = next(jobs)
+        except StopIteration:
+            break
+        except Exception as error:
+            #: A generator that raised is finished; the stages still have to
+            #: be closed so the jobs already in them aren't dropped
+            traceback.print_exc()
+            with done_lock:
+                done.append({'name': 'jobs', 'error': f'jobs: {error}'})
+            break
+        queues[0].put(job)
+
+    #: Close each stage once everything upstream of it has drained
+    for inbox, threads in zip(queues, workers):
+        inbox.put(_finished)
+        for thread in threads:
+            thread.join()
+
+    return done
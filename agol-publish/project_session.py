@@ -0,0 +1,105 @@
+#!/usr/bin/env python
+# * coding: utf8 *
+'''
+project_session.py
+
+Keep an ArcGIS Pro project and the map used for staging open across many
+layers instead of reopening, searching, clearing, and saving it for each one.
+'''
+
+import os
+
+import arcpy
+
+
+class PublishingSession:
+    '''An open Pro project and its staging map. The map is found, cleared, and
+    set to web mercator once when the session opens; after that each layer
+    only costs adding it, staging it, and removing it. Saves are deferred to
+    checkpoints.
+
+    Parameters:
+    project_path: Path to an existing ArcGIS Pro project
+    map_name: Name of the map in the Pro project to use
+    save_every: if specified, save the project after this many layers have
+                been removed; otherwise it is only saved by save() or close()
+    '''
+
+    def __init__(self, project_path, map_name, save_every=None):
+        self.project_path = project_path
+        self.save_every = save_every
+        self.project = arcpy.mp.ArcGISProject(project_path)
+
+        maps = self.project.listMaps(map_name)
+        if not maps:
+            raise ValueError(f'No map named {map_name} in {project_path}')
+        self.map = maps[0]
+
+        #: Remove any existing layers
+        for layer in self.map.listLayers():
+            self.map.removeLayer(layer)
+        for table in self.map.listTables():
+            self.map.removeTable(table)
+
+        #: Verify map projection
+        self.cim = self.map.getDefinition('V2')
+        if self.cim.spatialReference['wkid'] != 3857:
+            print('changing map projection')
+            self.cim.spatialReference = {'wkid': 3857}
+            self.map.setDefinition(self.cim)
+
+        #: {layer name: layer} for the layers in the map
+        self.layers = {}
+        self.unsaved = 1  #: Clearing the map is a change
+
+    def add(self, data_path, name):
+        '''Add data to the map as a layer named name.
+
+        returns: the new layer
+        '''
+        layer = self.map.addDataFromPath(data_path)
+        layer.name = name
+        self.layers[name] = layer
+        return layer
+
+    def sharing_draft(self, name, service_name):
+        '''returns: a hosted feature layer sharing draft for the named layer
+        '''
+        return self.map.getWebLayerSharingDraft('HOSTING_SERVER', 'FEATURE',
+                                                service_name,
+                                                [self.layers[name]])
+
+    def remove(self, name):
+        '''Remove the named layer from the map, saving if it's time for a
+        checkpoint.
+        '''
+        layer = self.layers.pop(name)
+
+        #: Something from .addDataFromPath() holds on to the source fgdb
+        #: until the process ends; pointing the layer somewhere else first
+        #: lets the temp folder be cleaned up (see create_service_definition
+        #: in NightStocker.py)
+        if layer.supports('DATASOURCE'):
+            workspace = os.path.dirname(layer.dataSource)
+            layer.updateConnectionProperties(workspace, r'c:\foo\bar.gdb',
+                                             auto_update_joins_and_relates=False,
+                                             validate=False)
+        self.map.removeLayer(layer)
+
+        self.unsaved += 1
+        if self.save_every and self.unsaved >= self.save_every:
+            self.save()
+
+    def save(self):
+        '''Save the project now if it has unsaved changes.
+        '''
+        if self.unsaved:
+            self.project.save()
+            self.unsaved = 0
+
+    def close(self):
+        '''Remove any layers left in the map and save the project.
+        '''
+        for name in list(self.layers):
+            self.remove(name)
+        self.save()
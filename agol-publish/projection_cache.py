@@ -0,0 +1,164 @@
+#!/usr/bin/env python
+# * coding: utf8 *
+'''
+projection_cache.py
+
+Reuse projected copies of SDE data between runs. Each copy is recorded with a
+fingerprint of its source (schema, row count, extent, and last edit or a
+checksum of its rows); the copy is reused while the fingerprint matches and
+rebuilt as soon as it doesn't.
+'''
+
+import hashlib
+import json
+import os
+import sqlite3
+
+import arcpy
+
+
+def fingerprint(source):
+    '''Summarize the things about a table or feature class that change when
+    its data does.
+
+    Parameters:
+    source: path to the table or feature class
+
+    returns: hex digest of the source's field definitions, row count, spatial
+             reference and extent (feature classes), and either its newest
+             edit date (if editor tracking is enabled) or a checksum of every
+             row's attributes and geometry (if it isn't)
+    '''
+    describe = arcpy.da.Describe(source)
+
+    fields = arcpy.ListFields(source)
+    summary = {
+        'fields': [(field.name, field.type, field.length, field.precision,
+                    field.scale, field.isNullable) for field in fields],
+        'count': int(arcpy.management.GetCount(source)[0])
+    }
+
+    if describe['datasetType'] == 'FeatureClass':
+        extent = describe['extent']
+        summary['wkid'] = describe['spatialReference'].factoryCode
+        summary['extent'] = [round(value, 6) for value in
+                             (extent.XMin, extent.YMin, extent.XMax, extent.YMax)]
+
+    edited_field = describe.get('editedAtFieldName')
+    if describe.get('editorTrackingEnabled') and edited_field:
+        with arcpy.da.SearchCursor(source, [edited_field],
+                                   sql_clause=(None, f'ORDER BY {edited_field} DESC')) as cursor:
+            for edited, in cursor:
+                summary['last_edit'] = str(edited)
+                break
+    else:
+        summary['rows'] = checksum(source, describe, fields)
+
+    return hashlib.sha1(json.dumps(summary, default=str).encode('utf8')).hexdigest()
+
+
+def checksum(source, describe, fields):
+    '''Hash every row of a source without editor tracking, so that attribute
+    edits that don't change its row count or extent are still noticed.
+    Reading the rows is much cheaper than projecting them again.
+
+    Parameters:
+    source: path to the table or feature class
+    describe: the source's arcpy.da.Describe() dictionary
+    fields: the source's arcpy.ListFields() list
+
+    returns: hex digest of the rows in ObjectID order
+    '''
+    names = [field.name for field in fields
+             if field.type not in ('Geometry', 'Blob', 'Raster')]
+    if describe['datasetType'] == 'FeatureClass':
+        names.append('SHAPE@WKB')
+
+    order = None
+    if describe.get('hasOID'):
+        order = (None, f'ORDER BY {describe["OIDFieldName"]}')
+
+    digest = hashlib.sha1()
+    with arcpy.da.SearchCursor(source, names, sql_clause=order) as cursor:
+        for row in cursor:
+            digest.update(repr(row).encode('utf8'))
+
+    return digest.hexdigest()
+
+
+class ProjectionCache:
+    '''An index of projected outputs and the fingerprints of the sources they
+    were made from, kept in a SQLite file so that it can be shared by several
+    processes and runs.
+
+    Parameters:
+    folder: folder for the index file (and, by convention, the outputs)
+    '''
+
+    def __init__(self, folder):
+        self.folder = folder
+        os.makedirs(folder, exist_ok=True)
+
+        self.connection = sqlite3.connect(os.path.join(folder, 'projections.sqlite'),
+                                          timeout=60)
+        self.connection.execute('''
+            CREATE TABLE IF NOT EXISTS projections (
+                output TEXT PRIMARY KEY,
+                source TEXT,
+                fingerprint TEXT
+            )''')
+        self.connection.commit()
+
+        #: {source: 'hit', 'new', or 'changed'} for this run
+        self.results = {}
+
+    def fetch(self, source, output, make):
+        '''Get an up-to-date projected copy of source at output, making it
+        only if it's missing or the source has changed since it was made.
+
+        Parameters:
+        source: path to the source table or feature class
+        output: path for the projected copy
+        make: function taking (source, output) that creates output,
+              replacing it if it exists
+
+        returns: output
+        '''
+        current = fingerprint(source)
+        row = self.connection.execute(
+            'SELECT source, fingerprint FROM projections WHERE output = ?',
+            (output,)).fetchone()
+
+        if row == (source, current) and arcpy.Exists(output):
+            print(f'{source} unchanged; reusing {output}')
+            self.results[source] = 'hit'
+            return output
+
+        self.results[source] = 'changed' if row else 'new'
+        make(source, output)
+
+        self.connection.execute(
+            'INSERT OR REPLACE INTO projections (output, source, fingerprint) '
+            'VALUES (?, ?, ?)', (output, source, current))
+        self.connection.commit()
+
+        return output
+
+    def close(self):
+        self.connection.close()
+
+
+def summary(results):
+    '''Describe a run's cache results.
+
+    Parameters:
+    results: iterable of 'hit', 'new', and 'changed'
+
+    returns: string, ie 'projection cache: 10 hits, 2 misses (1 new, 1 changed)'
+    '''
+    results = list(results)
+    hits = results.count('hit')
+    new = results.count('new')
+    changed = results.count('changed')
+    return (f'projection cache: {hits} hits, {new + changed} misses '
+            f'({new} new, {changed} changed)')
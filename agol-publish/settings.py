@@ -4,6 +4,9 @@ MAP_NAME = 'AGOL Upload'
 LIST_CSV = r'c:\temp\shelved.csv'
 TERMS_OF_USE_PATH = r'l:\sgid_to_agol\termsOfUse.html'
 LOG_PATH = r'c:\temp\shelved_log_hammer.csv'
+JOURNAL_PATH = r'c:\temp\shelved_journal.jsonl'
+PROJECTION_CACHE_DIR = r'c:\temp\projection_cache'
+TIMING_PATH = r'c:\temp\shelved_timing.jsonl'
 GSHEET_AUTH = r'c:\gis\git\agol-open-data-toolbox\agol-publish\client_secret.json'
 #: Note: these currently point to testing sheets.
 STEWARDSHIP_SHEET_KEY = '1Qu60mevJHwCvBAWAk6bF2NhwEykh5znWInaGzsxWG1c'
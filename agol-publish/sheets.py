@@ -0,0 +1,151 @@
+#!/usr/bin/env python
+# * coding: utf8 *
+'''
+sheets.py
+
+Batched access to the Google sheets the publishing scripts log to.
+'''
+
+import threading
+
+import pygsheets
+
+import timing
+
+
+def column_letter(number):
+    '''Convert a 1-based column number to its spreadsheet letters (28 -> AB).
+    '''
+    letters = ''
+    while number:
+        number, remainder = divmod(number - 1, 26)
+        letters = chr(65 + remainder) + letters
+    return letters
+
+
+class StewardshipSession:
+    '''A sync session for the stewardship sheet and the list of new AGOL
+    items. Authorizes once, loads the stewardship sheet once and indexes its
+    rows by SGID Data Layer, and then queues row updates and new rows locally
+    until flush() sends them in one batch update and one insert per sheet.
+
+    Parameters:
+    gsheet_auth: path to Google sheets authorization file
+    gsheet_keys: Tuple of keys to stewardship doc [0] and agol items doc [1]
+    flush_every: if specified, flush automatically after this many layers
+                 have been logged with layer_logged()
+    on_flush: if specified, called after each successful flush with the list
+              of layers passed to layer_logged() since the previous flush,
+              ie to record that they're safely in the sheets
+    '''
+
+    #: Column holding the SGID Data Layer name in the stewardship sheet
+    layer_column = 2
+
+    def __init__(self, gsheet_auth, gsheet_keys, flush_every=None, on_flush=None):
+        self.flush_every = flush_every
+        self.on_flush = on_flush
+
+        #: Held while reading or changing queued rows; reentrant so callers
+        #: can hold it across a find() and the update() that follows it
+        self.lock = threading.RLock()
+
+        client = pygsheets.authorize(service_file=gsheet_auth)
+        self.stewardship = client.open_by_key(gsheet_keys[0])[1]  #: Stewardship sheet is second tab
+        self.agol_items = client.open_by_key(gsheet_keys[1])[0]
+
+        #: Local copy of every row in the stewardship sheet's grid, plus any
+        #: queued new rows at the end
+        self.rows = self.stewardship.get_all_values(returnas='matrix',
+                                                    include_tailing_empty=True,
+                                                    include_tailing_empty_rows=True)
+        self.sheet_row_count = len(self.rows)
+
+        #: {SGID Data Layer: [row index, ...]}
+        self.layer_rows = {}
+        for i, row in enumerate(self.rows):
+            self.layer_rows.setdefault(row[self.layer_column], []).append(i)
+
+        self.changed = set()
+        self.new_agol_items = []
+        self.logged_layers = []
+
+    def find(self, layer_name):
+        '''Find the stewardship rows for an SGID Data Layer.
+
+        returns: list of (1-based row number, copy of the row) tuples
+        '''
+        with self.lock:
+            return [(i + 1, list(self.rows[i]))
+                    for i in self.layer_rows.get(layer_name, [])]
+
+    def update(self, row_number, values):
+        '''Queue new values for an existing stewardship row.
+        '''
+        with self.lock:
+            self.rows[row_number - 1] = values
+            self.changed.add(row_number - 1)
+
+    def append(self, values):
+        '''Queue a new row at the end of the stewardship sheet.
+
+        returns: the row number the new row will have
+        '''
+        with self.lock:
+            self.rows.append(values)
+            i = len(self.rows) - 1
+            self.layer_rows.setdefault(values[self.layer_column], []).append(i)
+            return i + 1
+
+    def append_agol_item(self, values):
+        '''Queue a new row at the end of the AGOL items sheet.
+        '''
+        with self.lock:
+            self.new_agol_items.append(values)
+
+    def layer_logged(self, layer=None):
+        '''Count a logged layer, flushing if flush_every layers have been
+        logged since the last flush.
+
+        Parameters:
+        layer: name of the layer, passed on to on_flush
+        '''
+        with self.lock:
+            self.logged_layers.append(layer)
+            if self.flush_every and len(self.logged_layers) >= self.flush_every:
+                self.flush()
+
+    def flush(self):
+        '''Send all the queued changes to Google: one batch update for
+        changed stewardship rows and one insert for each sheet's new rows.
+        '''
+        with self.lock, timing.span('sheets flush'):
+            updated = sorted(i for i in self.changed if i < self.sheet_row_count)
+            if updated:
+                ranges = [f'A{i + 1}:{column_letter(len(self.rows[i]))}{i + 1}'
+                          for i in updated]
+                self.stewardship.update_values_batch(ranges,
+                                                     [[self.rows[i]] for i in updated])
+
+            new_rows = self.rows[self.sheet_row_count:]
+            if new_rows:
+                self.stewardship.insert_rows(self.stewardship.rows,
+                                             number=len(new_rows),
+                                             values=new_rows, inherit=True)
+
+            if self.new_agol_items:
+                self.agol_items.insert_rows(self.agol_items.rows,
+                                            number=len(self.new_agol_items),
+                                            values=self.new_agol_items,
+                                            inherit=True)
+
+            print(f'Flushed {len(updated)} updated and {len(new_rows)} new '
+                  f'stewardship rows, {len(self.new_agol_items)} new AGOL items')
+
+            self.sheet_row_count = len(self.rows)
+            self.changed.clear()
+            self.new_agol_items = []
+            flushed, self.logged_layers = self.logged_layers, []
+
+            if self.on_flush:
+                self.on_flush(flushed)
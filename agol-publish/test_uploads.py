@@ -0,0 +1,200 @@
+#!/usr/bin/env python
+# * coding: utf8 *
+'''
+test_uploads.py
+
+Tests for uploads.ChunkedUpload against a local http.server stand-in for the
+portal's multipart addItem/addPart/commit/status calls.
+
+Run with python -m pytest (or python -m unittest) from this folder.
+'''
+
+import email.parser
+import email.policy
+import json
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import uploads
+
+mb = 1024 * 1024
+
+
+class Portal:
+    '''The stand-in portal's state: its items, what it has been asked to do,
+    and the failures it should fake.
+    '''
+
+    def __init__(self):
+        self.items = {}
+        self.calls = []
+        self.valid_token = 'token'
+        self.fail_part = None  #: part number to fail once with a server error
+        self.lock = threading.Lock()
+
+
+def handler(portal):
+    class Handler(BaseHTTPRequestHandler):
+
+        def log_message(self, *args):
+            pass
+
+        def reply(self, body):
+            data = json.dumps(body).encode('utf8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def form(self):
+            body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+            content_type = self.headers.get('Content-Type', '')
+            if not content_type.startswith('multipart/form-data'):
+                return {key: values[0] for key, values in parse_qs(body.decode('utf8')).items()}
+
+            message = email.parser.BytesParser(policy=email.policy.HTTP).parsebytes(
+                f'Content-Type: {content_type}\r\n\r\n'.encode('utf8') + body)
+            fields = {}
+            for part in message.iter_parts():
+                name = part.get_param('name', header='content-disposition')
+                value = part.get_payload(decode=True)
+                fields[name] = value if part.get_filename() else value.decode('utf8')
+            return fields
+
+        def handle_request(self, fields):
+            path = urlparse(self.path).path
+            action = path.rsplit('/', 1)[-1]
+            with portal.lock:
+                portal.calls.append((action, fields.get('partNum')))
+
+                if fields.get('token') != portal.valid_token:
+                    return {'error': {'code': 498, 'message': 'Invalid token.'}}
+
+                if action == 'addItem':
+                    item_id = f'item{len(portal.items)}'
+                    portal.items[item_id] = {'parts': {}, 'committed': False}
+                    return {'success': True, 'id': item_id}
+
+                item_id = path.split('/')[-2]
+                if item_id not in portal.items:
+                    return {'error': {'code': 400, 'message': 'Item does not exist.'}}
+                item = portal.items[item_id]
+
+                if action == 'addPart':
+                    part = int(fields['partNum'])
+                    if portal.fail_part == part:
+                        portal.fail_part = None
+                        return {'error': {'code': 500, 'message': 'Unable to add part.'}}
+                    item['parts'][part] = fields['file']
+                    return {'success': True}
+                if action == 'commit':
+                    item['committed'] = True
+                    return {'success': True}
+                if action == 'status':
+                    return {'status': 'completed' if item['committed'] else 'partial'}
+                if action == 'delete':
+                    del portal.items[item_id]
+                    return {'success': True}
+
+            return {'error': {'code': 400, 'message': f'Unknown action {action}'}}
+
+        def do_GET(self):
+            query = {key: values[0] for key, values in parse_qs(urlparse(self.path).query).items()}
+            self.reply(self.handle_request(query))
+
+        def do_POST(self):
+            self.reply(self.handle_request(self.form()))
+
+    return Handler
+
+
+class ChunkedUploadTests(unittest.TestCase):
+
+    def setUp(self):
+        self.portal = Portal()
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), handler(self.portal))
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.rest_url = f'http://127.0.0.1:{self.server.server_port}/sharing/rest'
+
+        self.folder = tempfile.mkdtemp()
+        self.path = os.path.join(self.folder, 'layer.sd')
+        self.data = os.urandom(11 * mb)
+        with open(self.path, 'wb') as sd_file:
+            sd_file.write(self.data)
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.folder)
+
+    def upload(self, token='token', **options):
+        return uploads.ChunkedUpload(self.rest_url, 'publisher', token, self.path,
+                                     chunk_size=5 * mb, **options)
+
+    def uploaded_data(self, item_id):
+        parts = self.portal.items[item_id]['parts']
+        return b''.join(parts[number] for number in sorted(parts))
+
+    def test_splits_into_parts_and_commits(self):
+        item_id = self.upload().run()
+
+        self.assertTrue(self.portal.items[item_id]['committed'])
+        self.assertEqual(sorted(self.portal.items[item_id]['parts']), [1, 2, 3])
+        self.assertEqual(self.uploaded_data(item_id), self.data)
+        self.assertFalse(os.path.exists(self.path + '.upload.json'))
+
+    def test_resumes_after_a_failed_part(self):
+        self.portal.fail_part = 2
+        with self.assertRaises(uploads.UploadError):
+            self.upload(retries=0).run()
+
+        with open(self.path + '.upload.json') as state_file:
+            self.assertEqual(json.load(state_file)['parts'], [1])
+
+        item_id = self.upload(retries=0).run()
+
+        actions = [action for action, _ in self.portal.calls]
+        self.assertEqual(actions.count('addItem'), 1)
+        self.assertEqual([part for action, part in self.portal.calls if action == 'addPart'],
+                         ['1', '2', '2', '3'])
+        self.assertEqual(self.uploaded_data(item_id), self.data)
+
+    def test_starts_over_when_the_file_changed(self):
+        self.portal.fail_part = 2
+        with self.assertRaises(uploads.UploadError):
+            self.upload(retries=0).run()
+
+        self.data = os.urandom(6 * mb)
+        with open(self.path, 'wb') as sd_file:
+            sd_file.write(self.data)
+        os.utime(self.path, (0, 0))
+
+        item_id = self.upload(retries=0).run()
+
+        self.assertEqual(list(self.portal.items), [item_id])  #: the partial item was deleted
+        self.assertEqual(self.uploaded_data(item_id), self.data)
+
+    def test_refreshes_an_expired_token(self):
+        tokens = {'current': 'expired'}
+
+        def refresh():
+            tokens['current'] = 'token'
+
+        item_id = self.upload(lambda: tokens['current'], retries=1,
+                              refresh_token=refresh).run()
+
+        self.assertEqual(self.uploaded_data(item_id), self.data)
+
+    def test_expired_token_without_refresh_fails(self):
+        with self.assertRaises(uploads.UploadError):
+            self.upload('expired', retries=0).run()
+
+
+if __name__ == '__main__':
+    unittest.main()
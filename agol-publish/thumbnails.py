@@ -0,0 +1,156 @@
+#!/usr/bin/env python
+# * coding: utf8 *
+'''
+thumbnails.py
+
+Create item thumbnails in the background so that publishing doesn't wait on
+them. Each item is retried with exponential backoff. Items are kept in a JSON
+retry file from the time they're queued until their thumbnail is created, so
+ones that failed or were never finished (the script crashed or was stopped)
+can be caught up later by running this module:
+
+    python thumbnails.py <agol user> [--retry-file <path>]
+
+The retry file defaults to thumbnails_retry.json in the temp folder.
+'''
+
+import argparse
+import concurrent.futures
+import getpass
+import json
+import os
+import tempfile
+import threading
+import time
+
+import arcgis
+
+import timing
+
+#: Where publishing scripts and the catch up command keep the retry file
+default_retry_path = os.path.join(tempfile.gettempdir(), 'thumbnails_retry.json')
+
+
+class ThumbnailQueue:
+    '''A pool of threads creating thumbnails for published items.
+
+    Parameters:
+    gis: An ArcGIS API gis item (used to look up items in catch_up()).
+    retry_path: JSON file of items whose thumbnails haven't been created yet
+    workers: number of thumbnails to create at the same time
+    retries: number of times to retry a failed thumbnail before recording it
+             in the retry file
+    delay: seconds to wait before the first retry; doubled for each retry
+           after that
+    '''
+
+    def __init__(self, gis, retry_path, workers=2, retries=4, delay=5):
+        self.gis = gis
+        self.retry_path = retry_path
+        self.retries = retries
+        self.delay = delay
+        self.pool = concurrent.futures.ThreadPoolExecutor(max_workers=workers)
+        self.futures = []
+        self.lock = threading.Lock()
+
+        #: ids of the items queued by this run
+        self.submitted = set()
+
+        #: {item id: last error, or 'queued'} of items still needing thumbnails
+        self.failed = {}
+        if os.path.exists(retry_path):
+            with open(retry_path) as retry_file:
+                self.failed = json.load(retry_file)
+
+    def submit(self, item):
+        '''Queue an item's thumbnail and return right away. The item is saved
+        in the retry file until its thumbnail has been created.
+        '''
+        self._record(item.id, 'queued')
+        self.submitted.add(item.id)
+        self.futures.append(self.pool.submit(self._create, item))
+
+    def _create(self, item):
+        for attempt in range(self.retries + 1):
+            try:
+                with timing.span('thumbnail', item=item.id, attempt=attempt):
+                    if item.create_thumbnail() is False:
+                        raise RuntimeError('create_thumbnail was not successful')
+            except Exception as error:
+                problem = str(error)
+                if attempt < self.retries:
+                    wait = self.delay * 2 ** attempt
+                    print(f'thumbnail for {item.id} failed ({problem}); '
+                          f'retrying in {wait}s')
+                    time.sleep(wait)
+            else:
+                self._record(item.id, None)
+                return True
+
+        print(f'error creating thumbnail for {item.id}, adding it to {self.retry_path}')
+        self._record(item.id, problem)
+        return False
+
+    def _record(self, item_id, error):
+        '''Add a queued or failed item to the retry file or remove a
+        finished one.
+        '''
+        with self.lock:
+            if error is None:
+                if item_id not in self.failed:
+                    return
+                del self.failed[item_id]
+            else:
+                self.failed[item_id] = error
+
+            temp_path = f'{self.retry_path}.tmp'
+            with open(temp_path, 'w') as retry_file:
+                json.dump(self.failed, retry_file, indent=2)
+            os.replace(temp_path, self.retry_path)
+
+    def close(self):
+        '''Wait for the queued thumbnails to finish.
+
+        returns: list of the ids of items queued by this run that are still
+                 missing thumbnails (not ones left in the retry file by
+                 earlier runs)
+        '''
+        concurrent.futures.wait(self.futures)
+        self.pool.shutdown()
+        self.futures = []
+        with self.lock:
+            return [item_id for item_id in self.failed if item_id in self.submitted]
+
+    def catch_up(self):
+        '''Queue every item in the retry file again.
+
+        returns: list of the ids of items still missing thumbnails
+        '''
+        for item_id in list(self.failed):
+            item = self.gis.content.get(item_id)
+            if item is None:
+                print(f'{item_id} no longer exists; dropping it')
+                self._record(item_id, None)
+                continue
+            self.submit(item)
+
+        return self.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Create the thumbnails that failed during publishing')
+    parser.add_argument('agol_user', help='AGOL user that owns the items')
+    parser.add_argument('--retry-file',
+                        default=default_retry_path,
+                        help=f'JSON file of items missing thumbnails (default: {default_retry_path})')
+    parser.add_argument('--workers', type=int, default=2,
+                        help='Number of thumbnails to create at once (default: 2)')
+    args = parser.parse_args()
+
+    gis = arcgis.gis.GIS('https://www.arcgis.com', args.agol_user,
+                         getpass.getpass(prompt=f'{args.agol_user}\'s password: '))
+    queue = ThumbnailQueue(gis, args.retry_file, args.workers)
+    print(f'retrying {len(queue.failed)} thumbnails')
+    missing = queue.catch_up()
+    print(f'{len(missing)} items are still missing thumbnails: {missing}')
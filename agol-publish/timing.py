@@ -0,0 +1,165 @@
+#!/usr/bin/env python
+# * coding: utf8 *
+'''
+timing.py
+
+Record how long each step of a run takes as nested spans tagged with the layer
+or item they were for. Spans are appended to a JSON lines file as they finish
+and summarized per stage (count, total, p50, p95) at the end of the run.
+
+Usage:
+    timing.start('NightStocker', timing.default_path('NightStocker'))
+    with timing.span('project', layer=name):
+        ...
+    timing.print_summary()
+'''
+
+import contextlib
+import datetime
+import itertools
+import json
+import os
+import tempfile
+import threading
+import time
+
+
+class Timer:
+    '''Collects spans for one run (or one worker process's part of a run).
+
+    Parameters:
+    run: label for the run, written with each span so several runs can share
+         a file
+    path: if specified, JSON lines file to append each span to
+    '''
+
+    def __init__(self, run=None, path=None):
+        self.run = run or f'run-{datetime.datetime.now():%Y%m%d-%H%M%S}'
+        self.spans = []
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.ids = itertools.count(1)
+        self.file = open(path, 'a') if path else None
+
+    @contextlib.contextmanager
+    def span(self, stage, parent=None, **ids):
+        '''Time the body of a with statement as a stage. Spans started inside
+        it on the same thread are recorded as its children.
+
+        Parameters:
+        stage: name of the step, ie 'project' or 'rest addPart'
+        parent: id of the parent span, for spans run on another thread than
+                their parent; defaults to the span this one is inside of
+        ids: identifiers to record with the span, ie layer=..., item=...
+
+        returns: the span's record, which the body can add more fields to
+        '''
+        stack = self.local.__dict__.setdefault('stack', [])
+        record = {'run': self.run, 'id': f'{os.getpid()}-{next(self.ids)}',
+                  'parent': parent or (stack[-1] if stack else None),
+                  'stage': stage,
+                  'start': datetime.datetime.now().isoformat()}
+        record.update(ids)
+        stack.append(record['id'])
+        started = time.perf_counter()
+        try:
+            yield record
+        except BaseException as error:
+            record['error'] = f'{type(error).__name__}: {error}'
+            raise
+        finally:
+            stack.pop()
+            record['seconds'] = time.perf_counter() - started
+            self.add([record])
+
+    def add(self, records):
+        '''Add finished spans, ie ones sent back from a worker process.
+        '''
+        with self.lock:
+            self.spans.extend(records)
+            if self.file:
+                for record in records:
+                    self.file.write(json.dumps(record, default=str) + '\n')
+                self.file.flush()
+
+    def drain(self):
+        '''Remove and return the spans recorded so far (to send them to
+        another process).
+        '''
+        with self.lock:
+            spans, self.spans = self.spans, []
+            return spans
+
+    def summary(self):
+        '''returns: list of (stage, count, total seconds, p50, p95, max)
+                 tuples, most total time first
+        '''
+        by_stage = {}
+        with self.lock:
+            for record in self.spans:
+                by_stage.setdefault(record['stage'], []).append(record['seconds'])
+
+        rows = []
+        for stage, seconds in by_stage.items():
+            seconds.sort()
+            rows.append((stage, len(seconds), sum(seconds),
+                         percentile(seconds, 50), percentile(seconds, 95),
+                         seconds[-1]))
+        rows.sort(key=lambda row: row[2], reverse=True)
+        return rows
+
+    def print_summary(self):
+        rows = self.summary()
+        if not rows:
+            return
+        print(f'\n{"stage":<28}{"count":>7}{"total s":>11}{"p50 s":>9}'
+              f'{"p95 s":>9}{"max s":>9}')
+        for stage, count, total, p50, p95, longest in rows:
+            print(f'{stage:<28}{count:>7}{total:>11.1f}{p50:>9.2f}{p95:>9.2f}'
+                  f'{longest:>9.2f}')
+
+    def close(self):
+        if self.file:
+            self.file.close()
+            self.file = None
+
+
+def percentile(ordered, percent):
+    '''Nearest-rank percentile of an already sorted list.
+    '''
+    rank = max(1, -(-len(ordered) * percent // 100))
+    return ordered[int(rank) - 1]
+
+
+#: The process's current timer; replaced by start()
+timer = Timer()
+
+
+def default_path(run):
+    '''returns: path of the JSON lines file for a script's spans in the
+             user's temp directory, ie %TEMP%\\OneTimePublish_timing.jsonl
+    '''
+    return os.path.join(tempfile.gettempdir(), f'{run}_timing.jsonl')
+
+
+def start(run, path=None):
+    '''Start timing a new run, replacing the current timer.
+
+    Parameters:
+    run: name of the script or run
+    path: if specified, JSON lines file to append spans to
+    '''
+    global timer
+    timer.close()
+    timer = Timer(f'{run}-{datetime.datetime.now():%Y%m%d-%H%M%S}', path)
+    return timer
+
+
+def span(stage, parent=None, **ids):
+    '''timer.span() for the current timer.
+    '''
+    return timer.span(stage, parent, **ids)
+
+
+def print_summary():
+    timer.print_summary()
@@ -0,0 +1,249 @@
+#!/usr/bin/env python
+# * coding: utf8 *
+'''
+uploads.py
+
+Upload large files (like service definitions) to AGOL in parts using the
+portal's multipart addItem/addPart/commit REST calls instead of one
+content.add() request. Finished parts are recorded in a state file so that an
+interrupted upload picks up with the next part instead of starting over.
+'''
+
+import json
+import math
+import os
+import time
+
+import requests
+
+import timing
+
+#: AGOL requires every part but the last to be at least 5 MB
+minimum_chunk_size = 5 * 1024 * 1024
+
+#: Error codes for an invalid or expired token
+token_errors = (498, 499)
+
+
+class UploadError(Exception):
+    '''A portal request failed (after any retries).
+    '''
+
+
+class ChunkedUpload:
+    '''A resumable multipart upload of one file as a new item.
+
+    Parameters:
+    rest_url: the portal's sharing REST url, ie
+              'https://www.arcgis.com/sharing/rest' (or a local stand-in)
+    username: owner of the new item
+    token: portal token to authenticate the requests with, or a function
+           returning the current token (tokens can expire during long uploads)
+    path: path of the file to upload
+    item_type: AGOL type of the new item
+    state_path: path of the file recording the upload's progress; defaults to
+                path + '.upload.json'
+    chunk_size: bytes per part (at least 5 MB unless it's the only part)
+    retries: number of times to retry a failed request before giving up
+    refresh_token: if specified, function called to get a new token when the
+                   portal says the current one has expired (token must then be
+                   a function returning the current token)
+    '''
+
+    def __init__(self, rest_url, username, token, path,
+                 item_type='Service Definition', state_path=None,
+                 chunk_size=8 * 1024 * 1024, retries=5, refresh_token=None):
+        self.user_url = f'{rest_url.rstrip("/")}/content/users/{username}'
+        self.token = token
+        self.refresh_token = refresh_token
+        self.path = path
+        self.item_type = item_type
+        self.state_path = state_path or f'{path}.upload.json'
+        self.chunk_size = max(chunk_size, minimum_chunk_size)
+        self.retries = retries
+        self.http = requests.Session()
+
+        self.size = os.path.getsize(path)
+        self.part_count = max(1, math.ceil(self.size / self.chunk_size))
+        self.state = None
+
+    def _request(self, method, url, files=None, **params):
+        '''Make a portal request, retrying with exponential backoff on
+        connection problems and server errors, and right away with a new token
+        if the token has expired.
+
+        returns: the response's json
+        '''
+        params['f'] = 'json'
+        for attempt in range(self.retries + 1):
+            params['token'] = self.token() if callable(self.token) else self.token
+            try:
+                with timing.span(f'rest {url.rsplit("/", 1)[-1]}', url=url,
+                                 attempt=attempt):
+                    response = self._send(method, url, params, files)
+                if response.status_code in token_errors:
+                    #: Some portals send these as the http status
+                    result = {'error': {'code': response.status_code,
+                                        'message': 'Invalid token'}}
+                else:
+                    response.raise_for_status()
+                    result = response.json()
+            except (requests.RequestException, ValueError) as error:
+                problem = str(error)
+            else:
+                if 'error' not in result:
+                    return result
+                problem = result['error'].get('message', result['error'])
+                code = result['error'].get('code', 500)
+                if code in token_errors and self.refresh_token and attempt < self.retries:
+                    print(f'{url}: token expired; getting a new one')
+                    self.refresh_token()
+                    continue
+                if code < 500:
+                    #: The request itself was bad; retrying won't help
+                    raise UploadError(f'{url}: {problem}')
+
+            if attempt < self.retries:
+                wait = 2 ** attempt
+                print(f'{url} failed ({problem}); retrying in {wait}s')
+                time.sleep(wait)
+
+        raise UploadError(f'{url}: {problem}')
+
+    def _send(self, method, url, params, files):
+        if method == 'GET':
+            return self.http.get(url, params=params, timeout=300)
+        return self.http.post(url, data=params, files=files, timeout=300)
+
+    def _load_state(self):
+        '''Load the state of an earlier attempt at this upload if there is one
+        and it was for this exact file; otherwise start a new state.
+        '''
+        stat = os.stat(self.path)
+        fresh = {'path': self.path, 'size': stat.st_size, 'mtime': stat.st_mtime,
+                 'chunk_size': self.chunk_size, 'item_id': None, 'parts': []}
+
+        if os.path.exists(self.state_path):
+            with open(self.state_path) as state_file:
+                state = json.load(state_file)
+            if all(state.get(key) == fresh[key]
+                   for key in ('path', 'size', 'mtime', 'chunk_size')):
+                self.state = state
+                return
+            print(f'{self.path} has changed since its last upload attempt; '
+                  'starting over')
+            if state.get('item_id'):
+                try:
+                    self._request('POST', f'{self.user_url}/items/{state["item_id"]}/delete')
+                except UploadError as error:
+                    print(f'Could not delete partial upload {state["item_id"]}: {error}')
+
+        self.state = fresh
+
+    def _save_state(self):
+        temp_path = f'{self.state_path}.tmp'
+        with open(temp_path, 'w') as state_file:
+            json.dump(self.state, state_file)
+        os.replace(temp_path, self.state_path)
+
+    def _report(self, sent, started):
+        '''Print progress with the transfer rate and time remaining for this
+        session's parts.
+        '''
+        done = min(len(self.state['parts']) * self.chunk_size, self.size)
+        elapsed = time.perf_counter() - started
+        rate = sent / elapsed if elapsed else 0
+        remaining = (self.size - done) / rate if rate else float('inf')
+        eta = time.strftime('%H:%M:%S', time.gmtime(remaining)) if rate else '?'
+        print(f'{os.path.basename(self.path)}: {done / 1048576:.1f} of '
+              f'{self.size / 1048576:.1f} MB, {rate / 1048576:.2f} MB/s, '
+              f'{eta} remaining')
+
+    def run(self):
+        '''Upload the file, resuming an earlier attempt if possible.
+
+        returns: the new item's id
+        '''
+        self._load_state()
+        name = os.path.basename(self.path)
+
+        if self.state['item_id']:
+            try:
+                self._request('GET', f'{self.user_url}/items/{self.state["item_id"]}/status')
+            except UploadError:
+                print(f'partial upload {self.state["item_id"]} of {name} is gone; '
+                      'starting over')
+                self.state['item_id'] = None
+                self.state['parts'] = []
+
+        if self.state['item_id']:
+            print(f'resuming upload of {name}: {len(self.state["parts"])} of '
+                  f'{self.part_count} parts already sent')
+        else:
+            result = self._request('POST', f'{self.user_url}/addItem',
+                                   multipart='true', filename=name,
+                                   type=self.item_type,
+                                   title=os.path.splitext(name)[0])
+            self.state['item_id'] = result['id']
+            self._save_state()
+
+        item_url = f'{self.user_url}/items/{self.state["item_id"]}'
+        started = time.perf_counter()
+        sent = 0
+        with open(self.path, 'rb') as source:
+            for part in range(1, self.part_count + 1):
+                if part in self.state['parts']:
+                    continue
+                source.seek((part - 1) * self.chunk_size)
+                chunk = source.read(self.chunk_size)
+                self._request('POST', f'{item_url}/addPart', partNum=part,
+                              files={'file': (name, chunk)})
+
+                self.state['parts'].append(part)
+                self._save_state()
+                sent += len(chunk)
+                self._report(sent, started)
+
+        print(f'committing {name}')
+        self._request('POST', f'{item_url}/commit', type=self.item_type)
+
+        #: Committing a multipart upload finishes asynchronously
+        wait = 1
+        while True:
+            status = self._request('GET', f'{item_url}/status')
+            if status.get('status') == 'completed':
+                break
+            if status.get('status') == 'failed':
+                raise UploadError(f'commit of {name} failed: '
+                                  f'{status.get("statusMessage")}')
+            time.sleep(wait)
+            wait = min(wait * 2, 30)
+
+        os.remove(self.state_path)
+        return self.state['item_id']
+
+
+def upload_item(gis, path, state_dir=None, **options):
+    '''Upload a file as a new item in the logged in user's root folder with a
+    ChunkedUpload.
+
+    Parameters:
+    gis: An ArcGIS API gis item.
+    path: path of the file to upload
+    state_dir: folder for the upload's state file; defaults to the file's
+               folder
+    options: other ChunkedUpload parameters (item_type, chunk_size, retries)
+
+    returns: the new arcgis.gis.Item
+
+    The token is read from gis for each request, and gis logs in again when
+    the portal reports it has expired.
+    '''
+    state_path = None
+    if state_dir:
+        state_path = os.path.join(state_dir, f'{os.path.basename(path)}.upload.json')
+
+    upload = ChunkedUpload(gis._portal.resturl, gis.users.me.username,
+                           lambda: gis._con.token, path, state_path=state_path,
+                           refresh_token=gis._con.relogin, **options)
+    return gis.content.get(upload.run())
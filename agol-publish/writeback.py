@@ -0,0 +1,100 @@
+#!/usr/bin/env python
+# * coding: utf8 *
+'''
+writeback.py
+
+Write published item ids back to SGID.META.AGOLItems in batches. Each id is
+recorded in a local queue file as soon as its item is published, and the
+queue is committed to the table in one edit session and one cursor pass per
+batch, since starting an edit session on the enterprise geodatabase costs far
+more than the edits themselves.
+'''
+
+import time
+
+import arcpy
+
+import durable
+import timing
+
+
+class ItemIdWriter:
+    '''A durable queue of (table name, item id) pairs for AGOLItems.
+
+    Parameters:
+    workspace: path to the sde connection to edit with
+    table: path to the AGOLItems table
+    queue_path: JSON lines file to keep uncommitted ids in; ids left there by
+                an earlier run are committed when the writer is created
+    commit_every: commit the queue once it has this many ids
+    commit_seconds: commit the queue when an id is recorded this long after
+                    the last commit, even if it has fewer than commit_every
+    key_field: field holding the table name
+    id_field: field to write the item id to
+    '''
+
+    def __init__(self, workspace, table, queue_path, commit_every=10,
+                 commit_seconds=300, key_field='TABLENAME',
+                 id_field='AGOL_ITEM_ID'):
+        self.workspace = workspace
+        self.table = table
+        self.queue_path = queue_path
+        self.commit_every = commit_every
+        self.commit_seconds = commit_seconds
+        self.key_field = key_field
+        self.id_field = id_field
+
+        #: {table name: item id} not yet committed
+        self.pending = {}
+        self.queue = durable.JsonLines(queue_path)
+        for name, item_id in self.queue.records:
+            self.pending[name] = item_id
+        self.last_commit = time.monotonic()
+
+        #: Ids left by a crashed run have to be in the table before anything
+        #: queries it for unpublished rows
+        if self.pending:
+            print(f'committing {len(self.pending)} item ids left in {queue_path}')
+            self.commit()
+
+    def record(self, name, item_id):
+        '''Queue an item id for a table, committing the queue if it's time.
+        '''
+        self.queue.append([name, item_id])
+        self.pending[name] = item_id
+
+        if len(self.pending) >= self.commit_every or \
+           time.monotonic() - self.last_commit >= self.commit_seconds:
+            self.commit()
+
+    def commit(self):
+        '''Write every queued id to the table in one edit session and clear
+        the queue.
+
+        Note: if the process dies after the edits are saved but before the
+        queue file is cleared, the same ids are written again by the next run.
+        '''
+        self.last_commit = time.monotonic()
+        if not self.pending:
+            return
+
+        names = ', '.join("'{}'".format(name.replace("'", "''")) for name in self.pending)
+        where = f'{self.key_field} IN ({names})'
+
+        written = set()
+        with timing.span('write back', rows=len(self.pending)), \
+             arcpy.da.Editor(self.workspace), \
+             arcpy.da.UpdateCursor(self.table, [self.key_field, self.id_field], where) as cursor:
+            for name, _ in cursor:
+                if name not in self.pending:
+                    continue  #: ie a case-insensitive match
+                cursor.updateRow((name, self.pending[name]))
+                written.add(name)
+
+        for name in set(self.pending) - written:
+            print(f'WARNING: no {self.key_field} = {name} row in {self.table}; '
+                  f'{self.pending[name]} was not written back')
+        print(f'wrote {len(written)} item ids to {self.table}')
+
+        self.pending = {}
+        self.queue.clear()
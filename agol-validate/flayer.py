@@ -19,8 +19,32 @@ import getpass
 import datetime
 import csv
 import logging
+import os
+import shutil
+import concurrent.futures
+import functools
+import itertools
+import json
+import sqlite3
+import sys
+import threading
+import time
+from collections import namedtuple
 import pandas as pd
 
+#: timing.py and crawler.py are shared with the publishing scripts; use
+#: their copies
+sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                             os.pardir, 'agol-publish'))
+import crawler
+import timing
+
+
+#: Column order for the feature service inventory created from item_info()
+inventory_columns = ['title', 'itemid', 'owner', 'folder', 'groups', 'tags',
+                     'authoritative', 'modified', 'views', 'sizeMB',
+                     'credits', 'data_requests_1Y', 'open_data']
+
 
 def usage_sum(df):
     '''
@@ -29,11 +53,21 @@ def usage_sum(df):
     return df['Usage'].sum()
 
 
-def item_info(item, folder):
+def item_info(item, folder, usage=True, groups=None, all_groups=False):
     '''
     Given an item object and a string representing the name of the folder it
     resides in, item_info builds a dictionary containing pertinent info about
     that item.
+
+    usage:      if False, skip the item.usage() call (and the
+                data_requests_1Y column) so usage can be collected separately
+                by a usage_collector
+    groups:     if specified, a group_index of the 'Utah SGID' groups to set
+                open_data from instead of asking AGOL for item.shared_with
+    all_groups: if True, ask AGOL for every group the item is shared with
+                (item.shared_with) for the groups column. Otherwise the
+                groups column only lists the item's 'Utah SGID' groups from
+                groups. Always True when groups isn't specified.
     '''
     item_dict = {}
     item_dict['itemid'] = item.itemid
@@ -46,22 +80,33 @@ def item_info(item, folder):
     item_dict['views'] = item.numViews
     item_dict['modified'] = datetime.datetime.fromtimestamp(item.modified/1000).strftime('%Y-%m-%d %H:%M:%S')
     item_dict['authoritative'] = item.content_status
-    
-    #: Sometimes we get a permission denied error on group listing, so we wrap
-    #: it in a try/except to keep moving
-    item_dict['open_data'] = 'no'
-    try:
-        gnames = []
-        for g in item.shared_with['groups']:
-            gnames.append(g.title)
-            if 'Utah SGID' in g.title:
-                item_dict['open_data'] = 'yes'
-        groups = ', '.join(gnames)
-    except:
-        groups = 'error'
+
+    sgid_groups = None
+    if groups is not None:
+        sgid_groups = groups.groups_for(item.itemid)
+        group_list = ', '.join(sgid_groups)
+
+    if all_groups or groups is None:
+        #: Sometimes we get a permission denied error on group listing, so we
+        #: wrap it in a try/except to keep moving.
+        try:
+            with timing.span('shared with', item=item.itemid):
+                gnames = [g.title for g in item.shared_with['groups']]
+            group_list = ', '.join(gnames)
+            if sgid_groups is None:
+                sgid_groups = [g for g in gnames if 'Utah SGID' in g]
+        except Exception as e:
+            logging.info('Error listing groups for {}: {}'.format(item.itemid, e))
+            group_list = 'error'
+    item_dict['groups'] = group_list
+
+    if sgid_groups is None:
         item_dict['open_data'] = 'unknown'
-    item_dict['groups'] = groups
-    
+    elif sgid_groups:
+        item_dict['open_data'] = 'yes'
+    else:
+        item_dict['open_data'] = 'no'
+
     tag_list = []
     for t in item.tags:
         tag_list.append(t)
@@ -71,14 +116,189 @@ def item_info(item, folder):
     item_dict['credits'] = mb*.24
     
     #: Sometimes data usage also gives an error, so try/except that as well
+    if usage:
+        try:
+            with timing.span('usage', item=item.itemid):
+                item_dict['data_requests_1Y'] = usage_sum(item.usage('1Y'))
+        except:
+            item_dict['data_requests_1Y'] = 'error'
+
+    return item_dict
+
+
+def safe_item_info(item, folder, usage=True, groups=None, all_groups=False):
+    '''
+    Wraps item_info() so that a failure on a single item doesn't stop a
+    harvest. If item_info() raises, the item gets a dictionary with 'error'
+    in every column it couldn't fill (and 'unknown' for open_data, just like
+    item_info() does when the group listing fails).
+    '''
     try:
-        item_dict['data_requests_1Y'] = usage_sum(item.usage('1Y'))
-    except:
-        item_dict['data_requests_1Y'] = 'error'
+        with timing.span('item info', item=item.itemid):
+            item_dict = item_info(item, folder, usage, groups, all_groups)
+    except Exception as e:
+        logging.info('Error getting info for {}: {}'.format(item.itemid, e))
+        item_dict = {column: 'error' for column in inventory_columns}
+        item_dict['itemid'] = item.itemid
+        item_dict['title'] = item.title
+        item_dict['folder'] = folder if folder else '_root'
+        item_dict['open_data'] = 'unknown'
 
+    print(item_dict['title'])
     return item_dict
 
 
+def harvest_item_info(items_and_folders, workers=1, usage=True, groups=None,
+                      all_groups=False):
+    '''
+    Runs item_info() on a list of (item, folder) tuples using a bounded pool
+    of threads. Each item_info() call makes several blocking REST calls, so
+    running them side by side cuts the wall-clock time of an inventory
+    considerably. The returned list of dictionaries is in the same order as
+    items_and_folders regardless of which calls finish first.
+
+    items_and_folders:  List of (item object, folder name) tuples
+    workers:            Maximum number of items to harvest at once. 1 harvests
+                        them one at a time.
+    usage:              Whether item_info() should fetch usage for each item
+    groups:             Optional group_index passed on to item_info()
+    all_groups:         Whether item_info() should list every group each item
+                        is shared with
+    '''
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as pool:
+        return list(pool.map(lambda pair: safe_item_info(*pair, usage, groups,
+                                                         all_groups),
+                             items_and_folders))
+
+
+def inventory_frame(records, items, usage=None, usage_windows=('1Y',)):
+    '''
+    Makes a dataframe of item_info() dictionaries with properly ordered column
+    names (dictionaries are unordered). If a usage_collector is given, the
+    items' usage for each of usage_windows is collected and swapped in where
+    the data_requests_1Y column would be.
+
+    records:        List of item_info() dictionaries
+    items:          List of the item objects the records came from
+    usage:          Optional usage_collector
+    usage_windows:  Usage windows to report when usage is specified
+    '''
+    items_df = pd.DataFrame.from_records(records, columns=inventory_columns)
+    if usage is None:
+        return items_df
+
+    usage_df = usage.collect(items, usage_windows)
+    columns = []
+    for column in inventory_columns:
+        if column == 'data_requests_1Y':
+            columns.extend(usage_df.columns)
+        else:
+            columns.append(column)
+    items_df = items_df.drop(columns='data_requests_1Y').merge(
+        usage_df, how='left', left_on='itemid', right_index=True)
+
+    return items_df[columns]
+
+
+class inventory_writer:
+    '''
+    Appends chunks of the feature service inventory to disk as they are
+    harvested so a crash only loses the chunk in progress. A path ending in
+    .csv is appended to in place; a path ending in .parquet is a directory
+    of numbered part files, one per chunk. Parquet parts are written with
+    every column as text so that chunks with 'error' values in numeric
+    columns still share a schema with the rest.
+
+    path:   Output .csv file or .parquet directory
+    resume: if True, keep what's already at path and note which itemids it
+            holds in self.written; otherwise start path over.
+    '''
+
+    def __init__(self, path, resume=False):
+        self.path = path
+        self.parquet = path.lower().endswith('.parquet')
+        self.written = set()
+        self.parts = 0
+
+        if resume and os.path.exists(path):
+            if not self.parquet:
+                self._trim_partial_row()
+            self.written = set(self.read()['itemid'].astype(str))
+            if self.parquet:
+                self.parts = len(self._part_paths())
+        elif self.parquet:
+            shutil.rmtree(path, ignore_errors=True)
+        elif os.path.exists(path):
+            os.remove(path)
+
+        if self.parquet:
+            os.makedirs(path, exist_ok=True)
+
+
+    def _trim_partial_row(self):
+        '''
+        Cuts off a row left half written by a crash so the next chunk starts
+        on a line of its own. A file without even a whole header row is
+        removed so the next chunk writes the header again.
+        '''
+        with open(self.path, 'rb+') as csv_file:
+            contents = csv_file.read()
+            end = contents.rfind(b'\n') + 1
+            if end < len(contents):
+                csv_file.truncate(end)
+        if end == 0:
+            os.remove(self.path)
+
+
+    def _part_paths(self):
+        return sorted(os.path.join(self.path, name)
+                      for name in os.listdir(self.path)
+                      if name.endswith('.parquet'))
+
+
+    def write(self, items_df):
+        '''
+        Flushes a chunk of the inventory (a dataframe from inventory_frame())
+        to disk.
+        '''
+        if self.parquet:
+            part_path = os.path.join(self.path,
+                                     'part-{:05d}.parquet'.format(self.parts))
+            #: Written under another name first so a crash can't leave a
+            #: half-written part behind
+            items_df.astype(str).to_parquet(part_path + '.tmp', index=False)
+            os.replace(part_path + '.tmp', part_path)
+            self.parts += 1
+        else:
+            items_df.to_csv(self.path, mode='a', index=False,
+                            header=not os.path.exists(self.path))
+        self.written.update(items_df['itemid'].astype(str))
+
+
+    def read(self):
+        '''
+        Returns everything written so far as a single dataframe (an empty one
+        with the inventory columns if nothing has been written yet).
+        '''
+        empty = pd.DataFrame(columns=inventory_columns)
+        if self.parquet:
+            if not os.path.isdir(self.path):
+                return empty
+            parts = [pd.read_parquet(part_path)
+                     for part_path in self._part_paths()]
+            if not parts:
+                return empty
+            return pd.concat(parts, ignore_index=True)
+
+        if not os.path.exists(self.path):
+            return empty
+        try:
+            return pd.read_csv(self.path, dtype={'itemid': str})
+        except pd.errors.EmptyDataError:
+            return empty
+
+
 def dict_writer(dictionary, out_path, header_row=None):
     with open(out_path, 'w', newline='') as out_file:
         writer = csv.writer(out_file)
@@ -101,6 +321,10 @@ def tag_case(tag, uppercased, articles):
     Note: No check is done for articles at the begining of a tag; all articles
     will be lowercased.
 
+    The tag_normalizer for each set of word lists is built once and reused,
+    but anything casing lots of tags should hold on to its own
+    tag_normalizer instead.
+
     tag:        The single or multi-word tag to check
     uppercased: Lower-cased list of words that should be uppercased (must be 
                 lower-cased to facilitate checking)
@@ -108,43 +332,576 @@ def tag_case(tag, uppercased, articles):
                 'in', 'of', etc
     '''
 
-    new_words = []
-    for word in tag.split():
+    return _cached_normalizer(tuple(uppercased), tuple(articles)).normalize(tag)
+
+
+@functools.lru_cache(maxsize=8)
+def _cached_normalizer(uppercased, articles):
+    return tag_normalizer(uppercased, articles)
+
+
+class tag_normalizer:
+    '''
+    Tag casing rules (see tag_case()) compiled once from the lists of words to
+    uppercase, articles, and tags to delete. Word lookups are done against
+    sets, and both whole tags and individual words are memoized in bounded
+    caches, so the same tags showing up on thousands of items are only
+    worked out once.
+
+    uppercased: Words that should be uppercased
+    articles:   Words that should always be lower-cased: 'in', 'of', etc
+    to_delete:  Tags that should be removed from items entirely
+    cache_size: Maximum number of tags (and words) to remember
+    '''
+
+    def __init__(self, uppercased, articles, to_delete=(), cache_size=8192):
+        self.uppercased = frozenset(word.lower() for word in uppercased)
+        self.articles = frozenset(word.lower() for word in articles)
+        self.to_delete = frozenset(tag.lower() for tag in to_delete)
+
+        #: Per-instance caches so different rule sets don't share results
+        self.normalize = functools.lru_cache(maxsize=cache_size)(
+            self._normalize)
+        self._case_word = functools.lru_cache(maxsize=cache_size)(
+            self._case_word)
+
+
+    def _case_word(self, word):
         cleaned_word = word.replace('.', '')
-        
+        check_word = cleaned_word.lower()
+
         #: Upper case specified words:
-        if cleaned_word.lower() in uppercased:
-            new_words.append(cleaned_word.upper())
+        if check_word in self.uppercased:
+            return cleaned_word.upper()
         #: Lower case articles/conjunctions 
-        elif cleaned_word.lower() in articles:
-            new_words.append(cleaned_word.lower())
+        if check_word in self.articles:
+            return check_word
         #: Title case everything else
+        return cleaned_word.title()
+
+
+    def _normalize(self, tag):
+        '''
+        Returns the properly-cased version of a single or multi-word tag.
+        '''
+        return ' '.join(self._case_word(word) for word in tag.split())
+
+
+    def fold(self, tag):
+        '''
+        Returns the key used to decide whether two tags are duplicates: the
+        normalized tag, lower-cased. ' Water-related' and 'water-Related' both
+        fold to 'water-related', 'U.S. Forest' and 'US Forest' to 'us forest'.
+        '''
+        return self.normalize(tag).lower()
+
+
+    def is_deleted(self, tag):
+        '''
+        True if the tag is one that should be removed from items.
+        '''
+        return tag.strip().lower() in self.to_delete
+
+
+    def normalize_all(self, tags):
+        '''
+        Normalizes a whole corpus of tags at once, returning a dictionary of
+        {original tag: normalized tag}. Each distinct tag is only worked out
+        once no matter how often it appears in tags.
+        '''
+        return {tag: self.normalize(tag) for tag in set(tags)}
+
+
+#: Lightweight stand-in for an item object, rebuilt from a snapshot_store row.
+#: Has just the attributes the tag reports need.
+snapshot_item = namedtuple('snapshot_item', ['itemid', 'title', 'owner',
+                                             'type', 'folder', 'modified',
+                                             'tags'])
+
+
+def fixed_tags(title, tags, groups, normalizer):
+    '''
+    Works out what an item's tags should be: uppercases SGID and AGRC,
+    fixes/keeps Utah if not in the title, removes tags in the list of bad tags
+    or that are already in the title, properly cases the rest, and adds the
+    category and SGID tags for any 'Utah SGID' groups the item is shared with.
+    Returns the new list of tags.
+
+    title:      The item's title
+    tags:       The item's current list of tags
+    groups:     List of the titles of the groups the item is shared with
+    normalizer: tag_normalizer holding the casing and deletion rules
+    '''
+
+    orig_tags = [t.strip() for t in tags]
+    title_words = title.split()
+
+    new_tags = []
+
+    #: Evaluate existing tags: upercase SGID and AGRC, fix/keep Utah
+    #: if not in title, remove if in list of bad tags, remove if in
+    #: title
+    for orig_tag in orig_tags:
+
+        #: Check if the tag is in the title (checking orig_tag instead
+        #: of cleaned_tag to avoid weird false positives in multi-word
+        #: tags catching the middle of a title- ie, 'Cycle Net' would
+        #: match the title 'Bicycle Network'. Probably not super
+        #: common, but oh well.)
+        #: These combine several boolean checks into a single variable
+        #: to be checked later.
+
+        #: single-word tag in title
+        single_word_tag_in_title = False
+        if orig_tag in title_words:
+            single_word_tag_in_title = True
+        #: multi-word tag in title
+        multi_word_tag_in_title = False
+        if ' ' in orig_tag and orig_tag in title:
+            multi_word_tag_in_title = True
+
+        #: operate on lower case to fix any weird mis-cased tags
+        cleaned_tag = orig_tag.lower()
+
+        #: Run checks on the tags. A check that modifies the tag should
+        #: append it to new_tags. A check that removes unwanted tags
+        #: should just pass. If a tag passes all the checks, it gets
+        #: properly cased and added to new_tags (the else clause).
+
+        #: Fix/keep 'Utah' if it's not in the title
+        if cleaned_tag == 'utah' and orig_tag not in title_words:
+            new_tags.append('Utah')
+        #: Don't add to new_tags if it should be deleted
+        elif normalizer.is_deleted(cleaned_tag):
+            pass
+        #: Don't add if it's in the title
+        elif single_word_tag_in_title or multi_word_tag_in_title:
+            pass
+        #: Otherwise, add the tag (properly-cased)
         else:
-            new_words.append(cleaned_word.title())
+            cased_tag = normalizer.normalize(orig_tag)
+            if cased_tag not in new_tags:
+                new_tags.append(cased_tag)
+
+    #: Add the category tag
+    for group in groups:
+        if 'Utah SGID' in group:
+            category = group.split('Utah SGID ')[-1]
+            #: If there's already a lowercase category tag, replace it
+            if category.lower() in new_tags:
+                new_tags.remove(category.lower())
+                new_tags.append(category)
+            elif category not in new_tags:
+                new_tags.append(category)
+            #: Make sure it's got SGID in it's tags
+            if 'SGID' not in new_tags:
+                new_tags.append('SGID')
+
+    return new_tags
+
+
+class rate_limiter:
+    '''
+    Spaces out calls from any number of threads so that no more than
+    max_per_second of them start in any one second.
+    '''
 
-    return ' '.join(new_words)
+    def __init__(self, max_per_second):
+        self.interval = 1 / max_per_second
+        self.lock = threading.Lock()
+        self.next_start = time.monotonic()
 
-class org:
 
-    #: A dictionary of tags and a list of items that are tagged thus
-    #: {tag:[item1, item2, ...]}
-    tags_and_items = {}
+    def wait(self):
+        '''
+        Blocks until the calling thread is allowed to make its call.
+        '''
+        with self.lock:
+            now = time.monotonic()
+            start = max(now, self.next_start)
+            self.next_start = start + self.interval
+        if start > now:
+            time.sleep(start - now)
+
+
+class snapshot_store:
+    '''
+    A local SQLite snapshot of the Feature Service items in a user's folders,
+    keyed by itemid and the item's modified timestamp. sync() compares a fresh
+    folder listing against the snapshot and only writes the items that are
+    new or have changed since the last run, and drops (and reports) the items
+    that have been deleted. items() hands back the snapshot as snapshot_item
+    tuples so the tag reports can run without going back to AGOL at all.
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        self.connection = sqlite3.connect(path)
+        self.connection.execute('''CREATE TABLE IF NOT EXISTS items (
+                                   itemid TEXT PRIMARY KEY,
+                                   modified INTEGER,
+                                   title TEXT,
+                                   owner TEXT,
+                                   type TEXT,
+                                   folder TEXT,
+                                   tags TEXT)''')
+        self.connection.commit()
+
+
+    def items(self):
+        '''
+        Returns a list of snapshot_items for every item in the snapshot,
+        sorted by folder and title.
+        '''
+        rows = self.connection.execute('''SELECT itemid, title, owner, type,
+                                          folder, modified, tags FROM items
+                                          ORDER BY folder, title''')
+        return [snapshot_item(itemid, title, owner, item_type, folder,
+                              modified, json.loads(tags))
+                for itemid, title, owner, item_type, folder, modified, tags
+                in rows]
+
+
+    def sync(self, items_and_folders, complete=True):
+        '''
+        Brings the snapshot up to date with a listing of the user's items.
+        Returns a dictionary of itemid lists: {'new': [...], 'changed': [...],
+        'deleted': [...], 'unchanged': [...]}.
+
+        items_and_folders:  List of (item object, folder name) tuples from a
+                            listing of the user's folders.
+        complete:           Whether the listing has every one of the user's
+                            items. If it does, any item in the snapshot that
+                            isn't in the listing is treated as deleted;
+                            otherwise (ie the search was truncated) nothing
+                            is deleted.
+        '''
+
+        known = {itemid: (modified, folder) for itemid, modified, folder
+                 in self.connection.execute(
+                     'SELECT itemid, modified, folder FROM items')}
+
+        changes = {'new': [], 'changed': [], 'deleted': [], 'unchanged': []}
+        rows = []
+        for item, folder in items_and_folders:
+            #: An item moved to another folder doesn't get a new modified
+            #: timestamp, so the folder is part of the check as well.
+            if item.itemid not in known:
+                changes['new'].append(item.itemid)
+            elif known.pop(item.itemid) != (item.modified, folder):
+                changes['changed'].append(item.itemid)
+            else:
+                changes['unchanged'].append(item.itemid)
+                continue
+            rows.append((item.itemid, item.modified, item.title, item.owner,
+                         item.type, folder, json.dumps(item.tags)))
+
+        #: Whatever is left over in known wasn't in the listing
+        if complete:
+            changes['deleted'] = sorted(known)
+        elif known:
+            print('Listing was truncated; keeping {} items missing from it '
+                  'in the snapshot'.format(len(known)))
+
+        with self.connection:
+            self.connection.executemany('INSERT OR REPLACE INTO items VALUES '
+                                        '(?, ?, ?, ?, ?, ?, ?)', rows)
+            self.connection.executemany('DELETE FROM items WHERE itemid = ?',
+                                        [(itemid,) for itemid
+                                         in changes['deleted']])
 
-    #: A list of tags sorted alphabetically
-    sorted_tags = []
+        return changes
 
-    #: A list of dictionaries that hold info about each item. As all 
-    #: dictionaries from item_info() will have the same keys, this list of
-    #: dictionaries can easily be converted to a pandas dataframe.
-    feature_services = []
 
-    #: A list of feature service item objects generated by trawling all of 
-    #: the user's folders
-    feature_service_items = []
+class group_index:
+    '''
+    Which groups each item is shared with, built by listing the content of
+    every group matching a search once and turning that inside out into
+    {itemid: [group title, ...]}. Looking up an item's groups is then a
+    dictionary lookup instead of an item.shared_with request per item.
+
+    Only the groups matching the query are indexed, so groups_for() leaves out
+    any other groups an item is shared with. That's fine for checking the
+    'Utah SGID' category groups, which is what the org's index is for, but
+    not for listing all of an item's groups.
+
+    gis:        An ArcGIS API gis object
+    query:      Group search query for the groups to index
+    title:      if specified, only groups with this in their title are
+                indexed (group searches match titles loosely)
+    max_items:  Maximum number of items to list from any one group
+    '''
+
+    def __init__(self, gis, query, title=None, max_items=10000):
+        self.gis = gis
+        self.query = query
+        self.title = title
+        self.max_items = max_items
+        self.groups_by_item = {}
+        self.refresh()
+
 
-    #: A dictionary of duplicate tags. The key is a lowercased check tag, and 
-    #: the value is a list of duplicate tags when ignoring case.
-    duplicate_tags = {}
+    def refresh(self):
+        '''
+        Rebuilds the index from the groups' current content.
+        '''
+        print('Indexing group content for "{}"...'.format(self.query))
+        groups_by_item = {}
+        with timing.span('group index', query=self.query):
+            for group in self.gis.groups.search(self.query, max_groups=1000):
+                if self.title and self.title not in group.title:
+                    continue
+                with timing.span('group content', group=group.id):
+                    content = group.content(max_items=self.max_items)
+                for item in content:
+                    groups_by_item.setdefault(item.itemid, []).append(group.title)
+        self.groups_by_item = groups_by_item
+
+
+    def groups_for(self, itemid):
+        '''
+        Returns a list of the titles of the indexed groups itemid is shared
+        with.
+        '''
+        return self.groups_by_item.get(itemid, [])
+
+
+class usage_collector:
+    '''
+    Collects item usage (data requests) for many items at once. Each item's
+    raw daily usage series for the past year is fetched on a pool of threads
+    and cached in a SQLite file, and is only fetched again once it is older
+    than ttl_hours. Totals for shorter windows (30D, 60D, 6M) are summed from
+    the cached series instead of asking AGOL again.
+
+    cache_path: Path to the SQLite cache (can be the same file as a
+                snapshot_store)
+    ttl_hours:  How long a cached series is good for
+    workers:    Number of concurrent item.usage() calls
+    '''
+
+    #: Usage windows and the number of days they cover
+    windows = {'30D': 30, '60D': 60, '6M': 182, '1Y': 365}
+
+    def __init__(self, cache_path, ttl_hours=24, workers=8):
+        self.ttl = datetime.timedelta(hours=ttl_hours)
+        self.workers = workers
+        self.connection = sqlite3.connect(cache_path)
+        with self.connection:
+            self.connection.execute('''CREATE TABLE IF NOT EXISTS usage_fetched (
+                                       itemid TEXT PRIMARY KEY,
+                                       fetched TEXT)''')
+            self.connection.execute('''CREATE TABLE IF NOT EXISTS usage (
+                                       itemid TEXT,
+                                       date TEXT,
+                                       usage INTEGER,
+                                       PRIMARY KEY (itemid, date))''')
+
+
+    @staticmethod
+    def _fetch(item):
+        '''
+        Returns (itemid, usage dataframe) or (itemid, None) if AGOL gives an
+        error.
+        '''
+        try:
+            with timing.span('usage', item=item.itemid):
+                return item.itemid, item.usage('1Y')
+        except Exception as e:
+            logging.info('Error getting usage for {}: {}'.format(item.itemid, e))
+            return item.itemid, None
+
+
+    def refresh(self, items):
+        '''
+        Fetches usage for any of items that aren't cached or whose cached
+        series has expired. Returns a set of the itemids that couldn't be
+        fetched.
+        '''
+        cutoff = (datetime.datetime.now() - self.ttl).isoformat()
+        fresh = {itemid for itemid, in self.connection.execute(
+                 'SELECT itemid FROM usage_fetched WHERE fetched >= ?',
+                 (cutoff,))}
+        stale = [item for item in items if item.itemid not in fresh]
+        print('Fetching usage for {} of {} items...'.format(len(stale),
+                                                            len(items)))
+
+        failed = set()
+        now = datetime.datetime.now().isoformat()
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.workers) as pool:
+            #: The threads only talk to AGOL; all the SQLite work stays on
+            #: this thread.
+            for itemid, usage_df in pool.map(self._fetch, stale):
+                if usage_df is None:
+                    failed.add(itemid)
+                    continue
+                rows = [(itemid, pd.Timestamp(date).strftime('%Y-%m-%d'),
+                         int(usage))
+                        for date, usage in zip(usage_df['Date'],
+                                               usage_df['Usage'])]
+                with self.connection:
+                    self.connection.execute('DELETE FROM usage WHERE itemid = ?',
+                                            (itemid,))
+                    self.connection.executemany('INSERT OR REPLACE INTO usage '
+                                                'VALUES (?, ?, ?)', rows)
+                    self.connection.execute('INSERT OR REPLACE INTO '
+                                            'usage_fetched VALUES (?, ?)',
+                                            (itemid, now))
+
+        return failed
+
+
+    def collect(self, items, windows=('1Y',)):
+        '''
+        Returns a dataframe indexed by itemid with a data_requests_<window>
+        column for each of windows, refreshing the cache as needed. Items
+        whose usage couldn't be fetched and isn't cached get 'error'.
+
+        items:      List of item objects
+        windows:    Keys of usage_collector.windows to total
+        '''
+        failed = self.refresh(items)
+        itemids = [item.itemid for item in items]
+
+        series = pd.read_sql_query('SELECT itemid, date, usage FROM usage',
+                                   self.connection, parse_dates=['date'])
+        series = series[series['itemid'].isin(itemids)]
+        cached = set(series['itemid'])
+
+        today = pd.Timestamp(datetime.date.today())
+        usage_df = pd.DataFrame(index=pd.Index(itemids, name='itemid'))
+        for window in windows:
+            in_window = series['date'] > today - pd.Timedelta(days=self.windows[window])
+            totals = series[in_window].groupby('itemid')['usage'].sum()
+            usage_df[f'data_requests_{window}'] = totals.reindex(
+                usage_df.index, fill_value=0).astype(object)
+
+        #: Items that failed and have nothing cached from an earlier run
+        errors = [itemid for itemid in failed if itemid not in cached]
+        usage_df.loc[errors, :] = 'error'
+
+        return usage_df
+
+
+class tag_index:
+    '''
+    Two-way index of items and their tags: tag -> items and item -> tags,
+    plus the tags grouped under a folded (lower-cased) key. Items are keyed by
+    itemid, so adding an item again replaces its old tags instead of counting
+    them twice, and update() can be used to re-index a single item after its
+    tags change without rebuilding anything else.
+
+    fold:   Function that turns a tag into the key used to group duplicate
+            tags (str.lower by default)
+    '''
+
+    def __init__(self, fold=str.lower):
+        self.fold = fold
+
+        #: {itemid: item}
+        self.items = {}
+
+        #: {itemid: [tag, ...]}
+        self.tags_by_item = {}
+
+        #: {tag: {itemid: item}}; the inner dict keeps insertion order
+        self.items_by_tag = {}
+
+        #: {folded tag: {tag: number of items with that tag}}
+        self.tags_by_key = {}
+
+        #: Tags that start with a space
+        self.spaced_tags = set()
+
+
+    def __len__(self):
+        return len(self.items)
+
+
+    def add(self, item, tags=None):
+        '''
+        Indexes an item under its tags. If the item is already in the index,
+        its old tags are replaced.
+
+        item:   The item object to index
+        tags:   The item's tags, if they differ from item.tags (ie, new tags
+                that have just been pushed to AGOL)
+        '''
+        if item.itemid in self.items:
+            self.remove(item.itemid)
+
+        tags = list(dict.fromkeys(item.tags if tags is None else tags))
+        self.items[item.itemid] = item
+        self.tags_by_item[item.itemid] = tags
+        for tag in tags:
+            self.items_by_tag.setdefault(tag, {})[item.itemid] = item
+            counts = self.tags_by_key.setdefault(self.fold(tag), {})
+            counts[tag] = counts.get(tag, 0) + 1
+            if tag.startswith(' '):
+                self.spaced_tags.add(tag)
+
+
+    def remove(self, itemid):
+        '''
+        Removes an item and any tags left without items from the index.
+        '''
+        self.items.pop(itemid, None)
+        for tag in self.tags_by_item.pop(itemid, []):
+            tagged = self.items_by_tag[tag]
+            del tagged[itemid]
+            if not tagged:
+                del self.items_by_tag[tag]
+                self.spaced_tags.discard(tag)
+
+            key = self.fold(tag)
+            counts = self.tags_by_key[key]
+            counts[tag] -= 1
+            if not counts[tag]:
+                del counts[tag]
+                if not counts:
+                    del self.tags_by_key[key]
+
+
+    #: Re-indexing an item is the same as adding it again
+    update = add
+
+
+    def tags(self):
+        '''
+        Returns an alphabetical list of every distinct tag.
+        '''
+        return sorted(self.items_by_tag)
+
+
+    def items_for(self, tag):
+        '''
+        Returns a list of the items tagged with tag.
+        '''
+        return list(self.items_by_tag.get(tag, {}).values())
+
+
+    def duplicates(self):
+        '''
+        Returns a dictionary of the folded keys that more than one distinct
+        tag folds to: {folded tag: [tag, tag, ...]}.
+        '''
+        return {key: list(counts) for key, counts in self.tags_by_key.items()
+                if len(counts) > 1}
+
+
+    def leading_space_tags(self):
+        '''
+        Returns a dictionary of the titles of items that have tags starting
+        with a space and a list of those tags: {title: [tag, tag, ...]}.
+        '''
+        spaced = {}
+        for tag in sorted(self.spaced_tags):
+            for item in self.items_by_tag[tag].values():
+                spaced.setdefault(item.title, []).append(tag)
+        return spaced
+
+
+class org:
 
     #: Tags or words that should be uppercased, saved as lower to check against
     uppercased_tags = ['2g', '3g', '4g', 'agrc', 'aog', 'at&t', 'blm', 'brat', 'caf', 'cdl', 'daq', 'dfcm', 'dfirm', 'dwq', 'e911', 'ems', 'fae', 'fcc', 'fema', 'gcdb', 'gis', 'gnis', 'hava', 'huc', 'lir', 'lrs', 'lte', 'luca', 'mrrc', 'nca', 'ng911', 'nox', 'npsbn', 'ntia', 'nwi', 'plss', 'pm10', 'psap', 'sbdc', 'sbi', 'sgid', 'sitla', 'sligp', 'trax', 'uca', 'udot', 'ugs', 'uhp', 'uic', 'us', 'usdw', 'usfs', 'usfws', 'usps', 'ustc', 'ut', 'uta', 'vcp', 'vista', 'voc']
@@ -156,31 +913,113 @@ class org:
     tags_to_delete = ['.sd', 'service definition']
 
 
-    def __init__(self, path, user_name):
+    def __init__(self, path, user_name, snapshot_path=None, offline=False):
+        '''
+        path:           URL of the portal
+        user_name:      User whose folders are evaluated
+        snapshot_path:  if specified, path to a snapshot_store SQLite file that
+                        is brought up to date with the user's folders
+        offline:        if True, don't connect to the portal at all; load the
+                        items from snapshot_path instead. Only the tag reports
+                        that don't modify items can be run offline.
+        '''
         logging.info('==========')
         logging.info('Portal: {}'.format(path))
         logging.info('User: {}'.format(user_name))
         logging.info('==========')
 
         self.user_name = user_name
+        self.normalizer = tag_normalizer(self.uppercased_tags, self.articles,
+                                         self.tags_to_delete)
+
+        #: Index of tags and the items that are tagged thus. Duplicate tags
+        #: are grouped by their normalized, lower-cased form.
+        self.index = tag_index(self.normalizer.fold)
+
+        #: A list of dictionaries that hold info about each item. As all 
+        #: dictionaries from item_info() will have the same keys, this list of
+        #: dictionaries can easily be converted to a pandas dataframe.
+        self.feature_services = []
+
+        #: A list of feature service item objects generated by trawling all of 
+        #: the user's folders
+        self.feature_service_items = []
+
+        #: A dictionary of duplicate tags. The key is a folded check tag, and 
+        #: the value is a list of duplicate tags when ignoring case.
+        self.duplicate_tags = {}
+
+        #: group_index of the org's 'Utah SGID' groups, built on first use by
+        #: get_group_index()
+        self.groups = None
+
+        self.snapshot = snapshot_store(snapshot_path) if snapshot_path else None
+
+        if offline:
+            if not self.snapshot:
+                raise ValueError('An offline org needs a snapshot_path')
+            print('Loading item snapshot from {}...'.format(snapshot_path))
+            self.gis = None
+            self.feature_service_items.extend(self.snapshot.items())
+            return
+
         self.gis = arcgis.gis.GIS(path, user_name,
                        getpass.getpass("{}'s password: ".format(user_name)))
 
         #: Get all the Feature Service item objects in the user's folders
-        user_item = self.gis.users.me
+        print('Getting item objects...')
+        items_and_folders = list(crawler.user_items(self.gis, self.user_name,
+                                                    'Feature Service'))
+        self.feature_service_items.extend(item for item, _ in items_and_folders)
+
+        if self.snapshot:
+            #: Past AGOL's search cap the listing is missing items, and they
+            #: mustn't be taken for deleted ones
+            complete = not crawler.truncated('owner:' + self.user_name,
+                                             'Feature Service')
+            changes = self.snapshot.sync(items_and_folders, complete)
+            print('Snapshot: {} new, {} changed, {} deleted, {} unchanged'.format(
+                  *[len(changes[key]) for key
+                    in ['new', 'changed', 'deleted', 'unchanged']]))
+            logging.info('Snapshot changes: {}'.format(changes))
+            if changes['deleted']:
+                print('Deleted since last snapshot: {}'.format(
+                      changes['deleted']))
+
+
+    def get_group_index(self, refresh=False):
+        '''
+        Returns a group_index of every 'Utah SGID' category group in the org,
+        whoever owns it, building it the first time it's needed. It's used
+        for the open_data column of the inventory and for adding category
+        tags when planning tag fixes.
 
-        #: Build list of folders. 'None' gives us the root folder.
-        print('Getting {}\'s folders...'.format(self.user_name))
-        folders = [None]
-        for folder in user_item.folders:
-            folders.append(folder['title'])
+        refresh:    if True, re-list the groups' content even if the index has
+                    already been built
+        '''
+        if self.groups is None:
+            self.groups = group_index(self.gis, 'title:"Utah SGID"', 'Utah SGID')
+        elif refresh:
+            self.groups.refresh()
+        return self.groups
 
-        #: Get info for every item in every folder
-        print('Getting item objects...')
-        for folder in folders:
-            for item in user_item.items(folder, 1000):
-                if item.type == 'Feature Service':
-                    self.feature_service_items.append(item)
+
+    @property
+    def tags_and_items(self):
+        '''
+        A dictionary of tags and a list of items that are tagged thus, built
+        from self.index: {tag:[item1, item2, ...]}
+        '''
+        return {tag: list(tagged.values())
+                for tag, tagged in self.index.items_by_tag.items()}
+
+
+    @property
+    def sorted_tags(self):
+        '''
+        A list of the indexed tags sorted alphabetically
+        '''
+        return self.index.tags()
 
 
     def get_users_tags_and_item_names(self, method='owner', out_path=None):
@@ -193,45 +1032,35 @@ class org:
                     Feature Layer items owned by the current owner. 'folder' adds 
                     all Feature Layer items in folders owned by the current owner.
                     These may give different results if other users' data is in 
-                    the user's folder. 
+                    the user's folder. An offline org always uses 'folder'.
 
         out_path:   if specified, the tag dictionary is sorted by tag name and 
                     then written out as a csv to this path.
         '''
 
-        if method == 'owner':
-            items = self.gis.content.search(query='owner:'+self.user_name, 
-                                            item_type='Feature Layer', 
-                                            max_items=1000)
-
-            #: Create dictionary of tags and a list of items that are tagged thus
-            print('Creating list of tags and the items associated with them...')
-            for item in items:
-                for tag in item.tags:
-                    if not tag in self.tags_and_items:
-                        self.tags_and_items[tag] = [item]
-                    else:
-                        self.tags_and_items[tag].append(item)
+        #: An offline org only has the snapshot of the folders to work with
+        if self.gis is None:
+            method = 'folder'
 
+        if method == 'owner':
+            items = crawler.search_items(self.gis, 'owner:' + self.user_name,
+                                         'Feature Service')
         elif method == 'folder':
-            for item in self.feature_service_items:
-                for tag in item.tags:
-                    if not tag in self.tags_and_items:
-                        self.tags_and_items[tag] = [item]
-                    else:
-                        self.tags_and_items[tag].append(item)
+            items = self.feature_service_items
 
-
-        #: For sanity's sake (this is in sigmund, after all), sort by name
-        self.sorted_tags = sorted(self.tags_and_items)
+        #: Index the tags and the items that are tagged thus
+        print('Creating list of tags and the items associated with them...')
+        for item in items:
+            self.index.add(item)
 
         #: Create a dictionary based on tags returning a list of the number of
-        #: items referenced by that tag and their titles for csv output
+        #: items referenced by that tag and their titles for csv output. For
+        #: sanity's sake (this is in sigmund, after all), sort by name.
         #: {tag: [3, foo, bar, baz], ...}
         length_dict = {}
         longest_tag_list = 0  #: For creating tag indices in csv header
-        for tag in self.tags_and_items:
-            item_titles = [item.title for item in self.tags_and_items[tag]]
+        for tag in self.index.tags():
+            item_titles = [item.title for item in self.index.items_for(tag)]
             #: First item in the list is the number of items with that tag
             length_dict[tag] = [len(item_titles)]
             #: Update longest_tag_list if needed
@@ -248,19 +1077,17 @@ class org:
 
     def tag_cloud(self, out_path=None):
         '''
-        Create a list of all tags in all the items in the user's folders
-        (self.feature_services). If out_path is specified, the tags are sorted,
-        added to a pandas series, and then written out as an .xls to out_path.
+        Create a list of all tags in all the indexed items (the items in the
+        user's folders if nothing has been indexed yet). If out_path is
+        specified, the tags are sorted, added to a pandas series, and then
+        written out as an .xls to out_path.
         '''
 
-        tags = []
-        for item in self.feature_service_items:
-            for tag in item.tags:
-                if tag not in tags:
-                    tags.append(tag)
+        if not self.index:
+            for item in self.feature_service_items:
+                self.index.add(item)
 
-        # print(sorted(tags))
-        tag_series = pd.Series(sorted(tags))
+        tag_series = pd.Series(self.index.tags())
         print(tag_series)
         if out_path:
             tag_series.to_excel(out_path)
@@ -268,26 +1095,19 @@ class org:
 
     def get_tags_with_leading_spaces(self, out_path=None):
         '''
-        Create a dictionary of items in self.tags_and_items with tags that have
+        Create a dictionary of indexed items with tags that have
         leading spaces and a list of all their spaced tags:
         {item:[bad_tag1, bad_tag2, ...]}. If out_path is specified, write the
         list as a csv.
         '''
 
-        #: Populate the dictionary of tags and associated items if it is not
+        #: Populate the index of tags and associated items if it is not
         #: already populated.
-        if not self.tags_and_items:
+        if not self.index:
             self.get_users_tags_and_item_names()
 
         print('Saving items with leading-space tags to {}...'.format(out_path))
-        leading_space_tagged = {}
-        for tag in self.tags_and_items:
-            if tag.startswith(' '):
-                for item in self.tags_and_items[tag]:
-                    if item.title not in leading_space_tagged:
-                        leading_space_tagged[item.title] = [tag]
-                    else:
-                        leading_space_tagged[item.title].append(tag)
+        leading_space_tagged = self.index.leading_space_tags()
 
         if out_path:
             dict_writer(leading_space_tagged, out_path)
@@ -296,50 +1116,27 @@ class org:
     def get_duplicate_tags(self, out_path=None):
         '''
         Identify any duplicate tags. Create dictionary of all check_tags
-        (lowercased version of all tags) that have more than one matching tag 
-        (ignoring the tags' case): 
+        (normalized, lowercased version of all tags; see tag_normalizer.fold())
+        that have more than one matching tag (ignoring the tags' case,
+        periods, and spacing): 
         {check_tag:[matching tag 1, matching tag 2, ...]}. 
         Write dictionary to out_path if specified.
         '''
         #: Method:
-        #: For each tag, create a lowercased check_tag version. If check_tag
-        #: hasn't been seen before, add it to dictionary of seen tags with value
-        #: of 1-element list of the actual tag. If it has been seen (check_tag
-        #: is in the dictionary keys), add this new actual tag to the list of
-        #: tags associated with the check_tag key. Afterwards, any value (list
-        #: of tags) in dictionary with len > 1 indicates functionally duplicate
-        #: tags.
-
-        #: Populate the dictionary of tags and associated items if it is not
+        #: self.index keeps every tag grouped under its folded check_tag as
+        #: items are added, so any check_tag with more than one tag in its
+        #: group indicates functionally duplicate tags.
+
+        #: Populate the index of tags and associated items if it is not
         #: already populated.
-        if not self.tags_and_items:
+        if not self.index:
             self.get_users_tags_and_item_names()
 
-        #: Dictionary of lower-cased tag and all other tags that match when 
-        #: lower-cased: {check_tag:[tag, tag, tag...]}
-        tags_by_check_tag = {}
+        self.duplicate_tags = self.index.duplicates()
 
         #: Used to generate header row indices
-        longest_tag_list = 0
-        
-        #: Start checking for dupes
-        for tag in self.tags_and_items:
-            check_tag = tag.lower()
-
-            #: What is useful information to report about duplicate tags?
-            related_itemids = [item.itemid for item in self.tags_and_items[tag]]
-            if check_tag in tags_by_check_tag:
-                tags_by_check_tag[check_tag].append(tag)
-                if len(tags_by_check_tag[check_tag]) > longest_tag_list:
-                    longest_tag_list = len(tags_by_check_tag[check_tag])
-            else:
-                tags_by_check_tag[check_tag] = [tag]
-
-        #: Create dictionary of duplicates where len(tag_list) > 1
-        self.duplicate_tags = {check_tag : tag_list
-                                for check_tag, tag_list
-                                in tags_by_check_tag.items()
-                                if len(tag_list) > 1}
+        longest_tag_list = max([len(tag_list) for tag_list
+                                in self.duplicate_tags.values()], default=0)
 
         if out_path:
             header_row = ['lowercase_check_tag']
@@ -347,152 +1144,220 @@ class org:
             dict_writer(self.duplicate_tags, out_path, header_row)
 
 
-    def tag_fixer(self):
+    def plan_tag_fixes(self, plan_path=None):
         '''
-        Automagically fix tags with spaces, certain capitalized tags, and 
-        redundant tags.
+        First half of tag_fixer(): works out the new tags for every item
+        without changing anything in AGOL. Only items whose tags would
+        actually change end up in the plan, which is returned as a dictionary
+        and, if plan_path is specified, saved as json so it can be reviewed
+        before apply_tag_fixes() is run:
+        {'created': timestamp, 'total': number of items evaluated,
+         'changes': [{'itemid':..., 'title':..., 'modified':...,
+                      'old_tags':[...], 'new_tags':[...]}, ...]}
         '''
 
         print('\nEvaluating services\' tags...')
         logging.info('==========')
-        logging.info('Fixing tags...')
-        failed_group_items = []
-        total = len(self.feature_service_items)
-        counter = 0
-        updated = 0
+        logging.info('Planning tag fixes...')
+        groups = self.get_group_index()
+        changes = []
         for item in self.feature_service_items:
-            counter += 1
-
-            orig_tags = [t.strip() for t in item.tags]
-
-            new_tags = []
-
-            #: Evaluate existing tags: upercase SGID and AGRC, fix/keep Utah
-            #: if not in title, remove if in list of bad tags, remove if in
-            #: title
-            for orig_tag in orig_tags:
-
-                #: Check if the tag is in the title (checking orig_tag instead
-                #: of cleaned_tag to avoid weird false positives in multi-word
-                #: tags catching the middle of a title- ie, 'Cycle Net' would
-                #: match the title 'Bicycle Network'. Probably not super
-                #: common, but oh well.)
-                #: These combine several boolean checks into a single variable
-                #: to be checked later.
-
-                #: single-word tag in title
-                single_word_tag_in_title = False
-                if orig_tag in item.title.split():
-                    single_word_tag_in_title = True
-                #: multi-word tag in title
-                multi_word_tag_in_title = False
-                if ' ' in orig_tag and orig_tag in item.title:
-                    multi_word_tag_in_title = True
-
-                #: operate on lower case to fix any weird mis-cased tags
-                cleaned_tag = orig_tag.lower()
-
-                #: Run checks on the tags. A check that modifies the tag should
-                #: append it to new_tags. A check that removes unwanted tags
-                #: should just pass. If a tag passes all the checks, it gets
-                #: properly cased and added to new_tags (the else clause).
-
-                #: Fix/keep 'Utah' if it's not in the title
-                if cleaned_tag == 'utah' and orig_tag not in item.title.split():
-                    new_tags.append('Utah')
-                #: Don't add to new_tags if it should be deleted
-                elif cleaned_tag in self.tags_to_delete:
-                    pass
-                #: Don't add if it's in the title
-                elif single_word_tag_in_title or multi_word_tag_in_title:
-                    pass
-                #: Otherwise, add the tag (properly-cased)
-                else:
-                    cased_tag = tag_case(orig_tag, 
-                                         self.uppercased_tags, 
-                                         self.articles)
-                    if cased_tag not in new_tags:
-                        new_tags.append(cased_tag)
-            
-            #: Add the category tag
-            groups = []
-            #: Wrap in try/except because some groups fail for some odd reason
-            try:
-                for g in item.shared_with['groups']:
-                    groups.append(g.title)
-            except:
-                failed_group_items.append(item.title)
-
-            for group in groups:
-                if 'Utah SGID' in group:
-                    category = group.split('Utah SGID ')[-1]
-                    #: If there's already a lowercase category tag, replace it
-                    if category.lower() in new_tags:
-                        new_tags.remove(category.lower())
-                        new_tags.append(category)
-                    elif category not in new_tags:
-                        new_tags.append(category)
-                    #: Make sure it's got SGID in it's tags
-                    if 'SGID' not in new_tags:
-                        new_tags.append('SGID')
-            
-            #: Only update if the tags have changed
+
+            new_tags = fixed_tags(item.title, item.tags,
+                                  groups.groups_for(item.itemid),
+                                  self.normalizer)
+
+            #: Only plan an update if the tags have changed
             if sorted(item.tags) != sorted(new_tags):
-                #: Update the item
-                print('\nUpdating {} ({} of {})'.format(item.title, counter, total))
-                print('Old tags: {}'.format(item.tags))
-                print('New tags: {}'.format(new_tags))
                 logging.info('Old tags <{}>: {}'.format(item.title, item.tags))
                 logging.info('New tags <{}>: {}'.format(item.title, new_tags))
-                item.update({'tags':new_tags})
+                changes.append({'itemid': item.itemid,
+                                'title': item.title,
+                                'modified': item.modified,
+                                'old_tags': list(item.tags),
+                                'new_tags': new_tags})
+
+        plan = {'created': datetime.datetime.now().isoformat(),
+                'total': len(self.feature_service_items),
+                'changes': changes}
+
+        print('{} of {} items need new tags'.format(len(changes), plan['total']))
+
+        if plan_path:
+            print('Saving tag plan to {}...'.format(plan_path))
+            with open(plan_path, 'w') as plan_file:
+                json.dump(plan, plan_file, indent=2)
+
+        return plan
+
+
+    def apply_tag_fixes(self, plan, workers=4, max_per_second=5):
+        '''
+        Second half of tag_fixer(): pushes the changes in a plan from
+        plan_tag_fixes() to AGOL using a pool of threads. Updates are rate
+        limited so a large plan doesn't hammer the portal. An item that has
+        been modified since the plan was made is skipped as 'stale' rather
+        than overwritten with out-of-date tags, and one that has been deleted
+        is reported as 'missing'.
+
+        plan:           Plan dictionary or path to a plan saved as json
+        workers:        Number of concurrent item.update() calls
+        max_per_second: Maximum number of updates to start per second
+
+        Returns a dictionary of the result of each change:
+        {itemid: 'updated' | 'stale' | 'missing' | 'failed' | 'error: <message>'}
+        '''
+
+        if isinstance(plan, str):
+            with open(plan) as plan_file:
+                plan = json.load(plan_file)
+
+        limiter = rate_limiter(max_per_second)
+        total = len(plan['changes'])
+
+        def apply_change(numbered_change):
+            counter, change = numbered_change
+            try:
+                #: Always fetch the item again: the objects in
+                #: feature_service_items are the ones the plan was made from,
+                #: so they can't show whether the item has changed since
+                item = self.gis.content.get(change['itemid'])
+                if item is None:
+                    return 'missing'
+                if item.modified != change['modified']:
+                    return 'stale'
+
+                limiter.wait()
+                print('Updating {} ({} of {})'.format(change['title'], counter,
+                                                      total))
+                with timing.span('tag update', item=change['itemid']):
+                    updated = item.update({'tags': change['new_tags']})
+                if not updated:
+                    return 'failed'
+            except Exception as e:
+                return 'error: {}'.format(e)
+            return 'updated'
+
+        logging.info('==========')
+        logging.info('Applying tag fixes...')
+        with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as pool:
+            outcomes = pool.map(apply_change, enumerate(plan['changes'], 1))
+            results = {change['itemid']: outcome for change, outcome
+                       in zip(plan['changes'], outcomes)}
+
+        updated = 0
+        for change in plan['changes']:
+            result = results[change['itemid']]
+            logging.info('{} <{}>: {}'.format(result, change['title'],
+                                              change['new_tags']))
+            if result == 'updated':
                 updated += 1
+                #: Keep the tag index current without a full rebuild
+                if change['itemid'] in self.index.items:
+                    self.index.update(self.index.items[change['itemid']],
+                                      change['new_tags'])
             else:
-                print('\nNot updating {} — Tags are the same ({} of {})'.format(item.title, counter, total))
-                print('Old tags: {}'.format(item.tags))
-                print('New tags: {}'.format(new_tags))
-                logging.info('Old tags <{}>: {}'.format(item.title, item.tags))
-                logging.info('New tags <{}>: {}'.format(item.title, new_tags))
+                print('Not updated: {} ({})'.format(change['title'], result))
 
-        print('\nUpdated {} of {} items'.format(updated, total))
-        if failed_group_items:
-            print('Could not determine group of: {}'.format(failed_group_items))
+        print('\nUpdated {} of {} items'.format(updated, plan['total']))
         logging.info('')
-        logging.info('Updated {} of {} items'.format(updated, total))
-        if failed_group_items:
-            logging.info('Could not determine group of: {}'.format(failed_group_items))
+        logging.info('Updated {} of {} items'.format(updated, plan['total']))
         logging.info('==========')
 
+        return results
+
+
+    def tag_fixer(self, plan_path=None, workers=4):
+        '''
+        Automagically fix tags with spaces, certain capitalized tags, and 
+        redundant tags. Plans the changes for every item and then applies just
+        the ones that change something (see plan_tag_fixes() and
+        apply_tag_fixes()).
+
+        plan_path:  if specified, the plan is also saved as json to this path
+        workers:    Number of concurrent updates
+        '''
+
+        plan = self.plan_tag_fixes(plan_path)
+        self.apply_tag_fixes(plan, workers)
 
-    def get_feature_services_info(self, out_path=None):
+
+    def get_feature_services_info(self, out_path=None, workers=1, usage=None,
+                                  usage_windows=('1Y',), stream_path=None,
+                                  chunk_size=100, resume=False,
+                                  all_groups=False):
         '''
         Creates a list of dictionaries holding information about each Feature 
         Service in every folder in an AGOL account and saves the list to an
         excel file.
+
+        out_path:   if specified, the list is written out as an excel file to
+                    this path.
+        workers:    Number of items to harvest concurrently (see
+                    harvest_item_info()). Output order is the same no matter
+                    how many workers are used.
+        usage:      if specified, a usage_collector used to get the items'
+                    usage instead of calling item.usage() in item_info()
+        usage_windows:  Usage windows to report when usage is specified, ie
+                        ('30D', '1Y'). Each gets a data_requests_<window>
+                        column.
+        stream_path:    if specified, items are harvested chunk_size at a time
+                        and each chunk is flushed to this .csv or .parquet
+                        path (see inventory_writer) instead of being kept in
+                        self.feature_services. out_path, if given, is then
+                        converted from the streamed file at the end.
+        chunk_size: Number of items per streamed chunk
+        resume:     if True, items already in stream_path are skipped so an
+                    interrupted run picks up after the last flushed chunk.
+                    Otherwise any existing stream_path is started over.
+        all_groups: if True, the groups column lists every group each item is
+                    shared with, at the cost of an item.shared_with request
+                    per item. Otherwise it only lists the 'Utah SGID' groups
+                    from get_group_index().
         '''
 
         print('Creating item information...')
-        user_item = self.gis.users.me
-
-        #: Build list of folders. 'None' gives us the root folder.
-        folders = [None]
-        for folder in user_item.folders:
-            folders.append(folder['title'])
-
-        #: Get info for every item in every folder
-        for folder in folders:
-            for item in user_item.items(folder, 1000):
-                if item.type == 'Feature Service':
-                    print(item.title)
-                    self.feature_services.append(item_info(item, folder))
-        
-        #: Make a dataframe with properly ordered column names (dictionaries 
-        #: are unordered) and then save that as an excel file.
-        items_df = pd.DataFrame.from_records(self.feature_services, columns = [
-                    'title', 'itemid', 'owner', 'folder', 'groups', 'tags',
-                    'authoritative', 'modified', 'views', 'sizeMB', 'credits',
-                    'data_requests_1Y', 'open_data'])
+        groups = self.get_group_index()
+
+        #: Every Feature Service in every folder, crawled lazily
+        items_and_folders = crawler.user_items(self.gis, self.user_name,
+                                               'Feature Service')
+
+        if not stream_path:
+            items_and_folders = list(items_and_folders)
+            self.feature_services.extend(harvest_item_info(items_and_folders,
+                                                           workers,
+                                                           usage is None,
+                                                           groups, all_groups))
+            items_df = inventory_frame(self.feature_services,
+                                       [item for item, _ in items_and_folders],
+                                       usage, usage_windows)
+            if out_path:
+                items_df.to_excel(out_path)
+            return
+
+        writer = inventory_writer(stream_path, resume)
+        if resume:
+            print('Resuming: skipping {} items already in {}'.format(
+                  len(writer.written), stream_path))
+            items_and_folders = ((item, folder) for item, folder
+                                 in items_and_folders
+                                 if item.itemid not in writer.written)
+
+        while True:
+            chunk = list(itertools.islice(items_and_folders, chunk_size))
+            if not chunk:
+                break
+            records = harvest_item_info(chunk, workers, usage is None, groups,
+                                        all_groups)
+            with timing.span('write chunk', items=len(chunk)):
+                writer.write(inventory_frame(records,
+                                             [item for item, _ in chunk],
+                                             usage, usage_windows))
+
         if out_path:
-            items_df.to_excel(out_path)
+            print('Converting {} to {}...'.format(stream_path, out_path))
+            writer.read().to_excel(out_path)
 
 
 if __name__ == '__main__':
@@ -504,17 +1369,26 @@ if __name__ == '__main__':
     now = datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
     logging.info('')
     logging.info('Start: {}'.format(now))
+    timing.start('flayer', r'c:\temp\agol_timing.jsonl')
 
     spaces_out = r'c:\temp\agol_spaced.csv'
     items_out = r'c:\temp\agol_layers_postshelf.xls'
+    items_stream = r'c:\temp\agol_layers_postshelf.csv'
     tags_out = r'c:\temp\agol_tags_and_items.csv'
     tag_cloud_out = r'c:\temp\agol_tag_cloud.xls'
     tags_items_out = r'c:\temp\agol_tags_items_2020-01-27.csv'
     dupe_tags_out = r'c:\temp\agol_tags_dupes.csv'
-    agrc = org('https://www.arcgis.com', 'UtahAGRC')
+    snapshot_path = r'c:\temp\agol_snapshot.db'
+    agrc = org('https://www.arcgis.com', 'UtahAGRC', snapshot_path)
+    #: Re-run the read-only tag reports against the last snapshot
+    # agrc = org('https://www.arcgis.com', 'UtahAGRC', snapshot_path, offline=True)
     agrc.get_users_tags_and_item_names('folder', tags_out)
     # agrc.get_tags_with_leading_spaces(spaces_out)
-    # agrc.get_feature_services_info(items_out)
+    # agrc.get_feature_services_info(items_out, workers=8,
+    #                                usage=usage_collector(snapshot_path),
+    #                                usage_windows=('30D', '6M', '1Y'),
+    #                                stream_path=items_stream, resume=True)
     # agrc.tag_cloud(tag_cloud_out)
     # agrc.tag_fixer()
     agrc.get_duplicate_tags(dupe_tags_out)
+    timing.print_summary()
@@ -0,0 +1,205 @@
+'''
+flayer_benchmark.py: Time flayer's tag analysis on made-up orgs
+
+Builds synthetic corpora of 1k to 100k fake feature service items with
+realistic-ish tags (mixed case, leading spaces, periods, acronyms, tags to be
+deleted) and runs each of flayer's tag analysis paths against them without
+ever talking to AGOL. For each path and corpus size, reports throughput in
+items per second and the peak memory allocated while it ran.
+
+Usage:
+    python flayer_benchmark.py [--sizes 1000 10000 100000] [--seed 42]
+'''
+
+import argparse
+import gc
+import logging
+import os
+import random
+import tempfile
+import time
+import tracemalloc
+
+import flayer
+
+
+#: Words used to build fake titles and tags
+words = ['address', 'points', 'roads', 'parcels', 'water', 'related', 'rights',
+         'wells', 'springs', 'county', 'boundaries', 'municipal', 'school',
+         'districts', 'trails', 'transit', 'stops', 'bus', 'routes', 'land',
+         'ownership', 'geology', 'faults', 'soils', 'wetlands', 'streams',
+         'lakes', 'elevation', 'contours', 'zip', 'codes', 'census', 'tracts',
+         'broadband', 'providers', 'health', 'hospitals', 'energy', 'mines',
+         'oil', 'gas', 'wildlife', 'habitat', 'recreation', 'parks', 'cadastre',
+         'imagery', 'index', 'fire', 'stations', 'lir', 'plss', 'agrc', 'sgid',
+         'udot', 'blm', 'usfs', 'u.s.', 'utah', 'of', 'the', 'in']
+
+#: Category groups items can be shared with
+categories = ['Boundaries', 'Cadastre', 'Demographic', 'Economy', 'Energy',
+              'Environment', 'Farming', 'Geoscience', 'Health', 'History',
+              'Indices', 'Location', 'Planning', 'Political', 'Recreation',
+              'Society', 'Transportation', 'Utilities', 'Water']
+
+
+def fake_tag(rng):
+    '''
+    Returns a one to three word tag with the kind of casing and spacing
+    problems tag_fixer() is meant to clean up.
+    '''
+    tag = ' '.join(rng.choices(words, k=rng.choice([1, 1, 1, 2, 2, 3])))
+    style = rng.random()
+    if style < .3:
+        tag = tag.title()
+    elif style < .4:
+        tag = tag.upper()
+    if rng.random() < .05:
+        tag = ' ' + tag
+    return tag
+
+
+def fake_corpus(size, seed):
+    '''
+    Returns a list of size flayer.snapshot_items and a dictionary of their
+    groups, {itemid: [group title, ...]}. Tags are drawn from a pool of
+    distinct tags with a skewed distribution so a few tags are very common,
+    like a real org.
+    '''
+    rng = random.Random(seed)
+    tag_pool = [fake_tag(rng) for _ in range(max(size // 10, 200))]
+    tag_pool.extend(['.sd', 'Service Definition', 'Utah', 'utah', 'SGID'])
+    weights = [1 / (rank + 1) for rank in range(len(tag_pool))]
+
+    items = []
+    groups = {}
+    for i in range(size):
+        itemid = '{:032x}'.format(i)
+        title = 'Utah ' + ' '.join(rng.choices(words, k=3)).title()
+        tags = rng.choices(tag_pool, weights, k=rng.randint(3, 12))
+        items.append(flayer.snapshot_item(itemid, title, 'UtahAGRC',
+                                          'Feature Service', None,
+                                          1500000000000 + i, tags))
+        if rng.random() < .8:
+            groups[itemid] = ['Utah SGID ' + rng.choice(categories)]
+
+    return items, groups
+
+
+def measure(name, size, function):
+    '''
+    Runs function once, returning a result row of
+    (name, size, seconds, items per second, peak MB).
+    '''
+    gc.collect()
+    tracemalloc.start()
+    start = time.perf_counter()
+    function()
+    seconds = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return (name, size, seconds, size / seconds if seconds else float('inf'),
+            peak / 1024 / 1024)
+
+
+def offline_org(items, snapshot_path):
+    '''
+    Returns a flayer.org loaded offline from a snapshot of items.
+    '''
+    store = flayer.snapshot_store(snapshot_path)
+    store.sync([(item, item.folder) for item in items])
+    store.connection.close()
+    return flayer.org(None, 'UtahAGRC', snapshot_path, offline=True)
+
+
+def run(sizes, seed, temp_dir):
+    '''
+    Runs every benchmark for each corpus size and returns the result rows.
+    '''
+    results = []
+    rules = (flayer.org.uppercased_tags, flayer.org.articles)
+
+    for size in sizes:
+        #: tag_case() keeps its compiled normalizer (and that normalizer's
+        #: cache of cased tags) between calls; start each size cold
+        flayer._cached_normalizer.cache_clear()
+
+        print('Building {} item corpus...'.format(size))
+        items, groups = fake_corpus(size, seed)
+        all_tags = [tag for item in items for tag in item.tags]
+        out_path = os.path.join(temp_dir, 'bench_{}.csv'.format(size))
+
+        def legacy_tag_case():
+            for tag in all_tags:
+                flayer.tag_case(tag, *rules)
+
+        def normalize_all():
+            flayer.tag_normalizer(*rules).normalize_all(all_tags)
+
+        def plan_tags():
+            normalizer = flayer.tag_normalizer(*rules, flayer.org.tags_to_delete)
+            for item in items:
+                flayer.fixed_tags(item.title, item.tags,
+                                  groups.get(item.itemid, []), normalizer)
+
+        def build_index():
+            index = flayer.tag_index(flayer.tag_normalizer(*rules).fold)
+            for item in items:
+                index.add(item)
+
+        agrc = offline_org(items,
+                           os.path.join(temp_dir, 'bench_{}.db'.format(size)))
+
+        def tags_and_items():
+            agrc.index = flayer.tag_index(agrc.normalizer.fold)
+            agrc.get_users_tags_and_item_names('folder')
+
+        def duplicate_tags():
+            #: An empty index makes get_duplicate_tags() build it, as it does
+            #: on a real run, instead of reusing the one from tags_and_items()
+            agrc.index = flayer.tag_index(agrc.normalizer.fold)
+            agrc.get_duplicate_tags()
+
+        #: Same shape as the tags and items report: {tag: [count, titles...]}
+        agrc.get_users_tags_and_item_names('folder')
+        report = {tag: [len(tagged)] + sorted(item.title for item in tagged)
+                  for tag, tagged in agrc.tags_and_items.items()}
+
+        def write_csv():
+            flayer.dict_writer(report, out_path)
+
+        for name, function in [('tag_case (per tag)', legacy_tag_case),
+                               ('tag_normalizer.normalize_all', normalize_all),
+                               ('fixed_tags (tag_fixer plan)', plan_tags),
+                               ('tag_index build', build_index),
+                               ('get_users_tags_and_item_names', tags_and_items),
+                               ('get_duplicate_tags', duplicate_tags),
+                               ('dict_writer', write_csv)]:
+            results.append(measure(name, size, function))
+
+        #: Let go of the snapshot so the temp directory can be removed
+        agrc.snapshot.connection.close()
+
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--sizes', type=int, nargs='+',
+                        default=[1000, 10000, 100000],
+                        help='Number of fake items in each corpus')
+    parser.add_argument('--seed', type=int, default=42,
+                        help='Random seed so runs are comparable')
+    args = parser.parse_args()
+
+    #: flayer logs every tag decision; keep that out of the timings
+    logging.disable(logging.INFO)
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        rows = run(args.sizes, args.seed, temp_dir)
+
+    print('\n{:<32}{:>9}{:>11}{:>14}{:>11}'.format('path', 'items', 'seconds',
+                                                  'items/sec', 'peak MB'))
+    for name, size, seconds, rate, peak in rows:
+        print('{:<32}{:>9}{:>11.3f}{:>14,.0f}{:>11.1f}'.format(name, size,
+                                                              seconds, rate,
+                                                              peak))